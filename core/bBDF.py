@@ -6,11 +6,33 @@ import numpy as np
 import os
 import yaml
 import io
+import zlib
+import lzma
+import bz2
+import fcntl
+from collections import OrderedDict
+import binio
 
 ENCODING = "utf-8"
 FIRST_LINE = "#BBDF 1.0 Basic Binary Data Format"
 LAST_LINE = "# >>> data start below >>>"
 DEFAULT_DTYPE = "f"
+# number of memory maps kept open by a Dataset (one per file)
+MAXMMAPS = 4
+
+# codecs for the compressed flavor: name -> (compress, decompress)
+# compress(raw, level) -> bytes, decompress(block) -> bytes
+codecs = {
+    "zlib": (lambda raw, level: zlib.compress(raw, level), zlib.decompress),
+    "lzma": (lambda raw, level: lzma.compress(raw, preset=level), lzma.decompress),
+    "bz2": (lambda raw, level: bz2.compress(raw, level), bz2.decompress),
+}
+
+
+def register_codec(name, compress, decompress):
+    """add a codec for the compressed flavor of bBDF"""
+    codecs[name] = (compress, decompress)
+
 
 header_sample = """\
 #BBDF 1.0 Basic Binary Data Format
@@ -54,20 +76,59 @@ def roundup(x, y):
 
 
 class Dataset():
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=False):
         self.filename = filename
         self.has_stripes = False
+        self.is_compressed = False
         self.ndims = 0
+        # in mmap mode, read_variable returns read-only views on the
+        # file instead of freshly allocated arrays
+        self.use_mmap = use_mmap
+        self._mmaps = OrderedDict()
+        # the locked file of the writer of a compressed file
+        self._writefid = None
+
+    def __getstate__(self):
+        # memory maps are attached to the process, they are not
+        # transferred to the workers of a pool
+        state = self.__dict__.copy()
+        state["_mmaps"] = OrderedDict()
+        state["_writefid"] = None
+        return state
+
+    def get_mmap(self):
+        """return the (cached) read-only memory map of the current file
+
+        the MAXMMAPS most recently used maps are kept, an evicted map
+        is unmapped once the arrays viewing it are released (a
+        RegDataset switches to a new file per date, the maps of the
+        past dates must not accumulate)
+        """
+        if self.filename in self._mmaps:
+            self._mmaps.move_to_end(self.filename)
+        else:
+            while len(self._mmaps) >= MAXMMAPS:
+                self._mmaps.popitem(last=False)
+            self._mmaps[self.filename] = np.memmap(self.filename,
+                                                   dtype="u1",
+                                                   mode="r")
+        return self._mmaps[self.filename]
+
+    def close(self):
+        """release the memory maps"""
+        self._mmaps = OrderedDict()
 
     def set_structure(self, userinfos):
         self.infos = userinfos
         self.header = generate_header(userinfos)
         self.has_stripes = "stripes" in userinfos
+        self.is_compressed = "compression" in userinfos
         self.ndims = len(userinfos["dimensions"])
         self.dims = tuple(userinfos["dimensions"].keys())
         self.set_dimcount(userinfos)
         self.set_offsets(userinfos)
         self.update_infos()
+        self.set_offset_table()
         #self.header = generate_header(self.infos)
         # self.write_header()
 
@@ -78,16 +139,23 @@ class Dataset():
         self.infos = userinfos
         self.header = header
         self.has_stripes = "stripes" in userinfos
+        self.is_compressed = "compression" in userinfos
         self.ndims = len(userinfos["dimensions"])
         self.dims = tuple(userinfos["dimensions"].keys())
         self.set_dimcount(userinfos)
         self.set_offsets(userinfos)
         self.update_infos()
+        self.set_offset_table()
+        if self.is_compressed:
+            self.read_index()
 
         return userinfos
 
     @property
     def filesize(self):
+        if self.is_compressed:
+            # the blocks are appended when written
+            return self.headersize+8
         dim0 = self.dims[0]
         datasize = self.dimcount[dim0]*self.dimsize[dim0]
         if self.has_stripes:
@@ -139,6 +207,8 @@ class Dataset():
             self.toc[name] = {"shape": tuple(shape),
                               "offset": offset,
                               "dtype": dtype}
+            if "scale_factor" in varinfos:
+                self.toc[name]["packing"] = get_packing(varinfos, dtype)
             offset += np.nbytes[dtype]*np.prod(shape)
 
         self.dimsize = {}
@@ -147,51 +217,444 @@ class Dataset():
             if (k == 0) and self.has_stripes:
                 roundingsize = infos["stripes"]["roundingsize"]
                 stripesize = infos["stripes"]["size"]
+                msg = (f"the data of one stripe ({offset} bytes) "
+                       f"does not fit in the stripe size ({stripesize})")
+                assert offset <= stripesize, msg
                 offset = stripesize  # roundup(offset, roundingsize)
                 #self.stripesize = offset
             self.dimsize[name] = offset
             offset = self.dimsize[name]*self.dimcount[name]
 
-    def read_variable(self, name, idx):
+    def set_offset_table(self):
+        """precompute the offsets of all (idx, variable)
+
+        self.offset_table[idx+(ivar,)] is the offset of variable
+        self.varnames[ivar] at index idx
+        """
+        counts = [self.dimcount[dname] for dname in self.dims]
+        self.varnames = list(self.toc)
+        self.varindex = {name: k for k, name in enumerate(self.varnames)}
+        table = np.zeros(counts+[len(self.varnames)], dtype="i8")
+        table += self.headersize
+        for k, dname in enumerate(self.dims):
+            shape = [1]*(self.ndims+1)
+            shape[k] = counts[k]
+            offset = np.arange(counts[k], dtype="i8")*self.dimsize[dname]
+            table += offset.reshape(shape)
+        table += np.asarray([self.toc[name]["offset"]
+                             for name in self.varnames], dtype="i8")
+        self.offset_table = table
+        if self.is_compressed:
+            # index[idx+(ivar,)] is (offset, size, capacity) of the
+            # compressed block, the capacity is the size of its slot.
+            # The offset of the index is in the 8 bytes after the
+            # header, the blocks are appended after them
+            self.index = np.zeros(counts+[len(self.varnames), 3], dtype="i8")
+            self.offset_table = self.index[..., 0]
+            self.endoffset = self.headersize+8
+
+    def unpack(self, name, raw, out=None):
+        """convert the stored values of `name` to physical values
+
+        for a quantized variable, raw*scale_factor+add_offset in
+        float32 and the fill values become NaN, otherwise raw is
+        returned (or copied into out)
+        """
+        packing = self.toc[name].get("packing")
+        if packing is None:
+            if out is None:
+                return raw
+            out[...] = raw
+            return out
+        if out is None:
+            out = np.empty(np.shape(raw), dtype="f")
+        out[...] = raw
+        out *= packing["scale_factor"]
+        out += packing["add_offset"]
+        np.putmask(out, raw == packing["_FillValue"], np.nan)
+        return out
+
+    def pack(self, name, data):
+        """convert physical values of `name` to the stored values
+
+        for a quantized variable the values are rounded to the
+        nearest integer and clipped, NaN are stored as _FillValue
+        """
+        dtype = self.toc[name]["dtype"]
+        packing = self.toc[name].get("packing")
+        if packing is None:
+            return np.asarray(data).astype(dtype)
+        data = np.asarray(data, dtype="f8")
+        lo, hi = packing["valid_range"]
+        scaled = np.rint((data-packing["add_offset"])/packing["scale_factor"])
+        scaled = np.clip(scaled, lo, hi)
+        scaled[np.isnan(data)] = packing["_FillValue"]
+        return scaled.astype(dtype)
+
+    def read_index(self):
+        """read the index of a compressed file
+
+        the index is stored after the last block, its offset is in the
+        8 bytes that follow the header
+        """
+        index, indexoffset = self.load_index()
+        self.index[:] = index
+        self.endoffset = indexoffset
+
+    def load_index(self, filename=None):
+        """the (index, index offset) of the compressed file `filename`
+        (default self.filename), the dataset is not modified
+
+        use it to read a file that has the structure of this dataset
+        but is not self.filename (e.g. another date)
+        """
+        filename = self.filename if filename is None else filename
+        filesize = os.path.getsize(filename)
+        nbytes = self.index.nbytes
+        start = self.headersize+8
+        msg = f"{filename} has no valid index"
+        assert filesize >= start+nbytes, msg
+        indexoffset = int(np.fromfile(filename, dtype="i8", count=1,
+                                      offset=self.headersize)[0])
+        # (the file may continue after the index, with the blocks of
+        # a writer that has not committed its index yet)
+        assert start <= indexoffset <= filesize-nbytes, msg
+        index = np.fromfile(filename, dtype="i8",
+                            count=self.index.size, offset=indexoffset)
+        index = index.reshape(self.index.shape)
+        offsets, sizes, capacities = index[..., 0], index[..., 1], index[..., 2]
+        written = offsets > 0
+        assert np.all(offsets[written] >= start), msg
+        assert np.all(sizes <= capacities), msg
+        assert np.all(offsets[written]+capacities[written] <= indexoffset), msg
+        return index, indexoffset
+
+    def write_index(self):
+        """write the index of a compressed file (call it once all the
+        blocks have been written), this ends the writing session"""
+        assert self.is_compressed
+        fid = self.lock_for_writing()
+        self.dump_index(fid)
+        fid.close()
+        self._writefid = None
+
+    def dump_index(self, fid):
+        """write the index at self.endoffset, then its offset
+
+        the index is on disk before its offset is written, so that
+        the file always has a valid index: the previous one until the
+        new one is committed
+        """
+        fid.seek(self.endoffset)
+        fid.write(self.index.tobytes())
+        fid.truncate()
+        fid.flush()
+        os.fsync(fid.fileno())
+        fid.seek(self.headersize)
+        fid.write(np.asarray([self.endoffset], dtype="i8").tobytes())
+        fid.flush()
+
+    def lock_for_writing(self):
+        """open the compressed file for writing, with an exclusive lock
+
+        a compressed file has a single writer at a time: the blocks
+        are appended and the index is kept in memory until
+        write_index(), which releases the lock. A second writer
+        (another process or another Dataset) fails instead of
+        corrupting the file. The index is read from the file once the
+        lock is taken, so that the successive writers append after
+        each other. The new blocks go after the end of the file: the
+        index on disk stays valid for the readers (and after a crash)
+        until write_index() commits the new one.
+        """
+        if self._writefid is None:
+            fid = open(self.filename, "rb+")
+            try:
+                fcntl.flock(fid.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fid.close()
+                raise RuntimeError(
+                    f"{self.filename} is being written by another writer")
+            self._writefid = fid
+            self.read_index()
+            self.endoffset = os.fstat(fid.fileno()).st_size
+        return self._writefid
+
+    def read_block(self, name, idx, fid=None):
+        """return the compressed block of `name` at `idx`"""
+        offset, size, _ = self.index[self.tableindex(name, idx)]
+        if fid is not None:
+            fid.seek(offset)
+            return fid.read(size)
+        elif self.use_mmap:
+            return self.get_mmap()[offset:offset+size]
+        else:
+            return np.fromfile(self.filename, dtype="u1", count=size,
+                               offset=offset)
+
+    def decompress(self, name, block, out=None):
+        """decompress `block` into `out` (allocated if None)"""
+        shape = self.toc[name]["shape"]
+        dtype = self.toc[name]["dtype"]
+        if out is None:
+            out = np.zeros(shape, dtype=dtype)
+        if len(block) > 0:
+            decompress = codecs[self.infos["compression"]["codec"]][1]
+            raw = decompress(block)
+            out.reshape(-1)[:] = np.frombuffer(raw, dtype=dtype)
+        return out
+
+    def offsets(self, names, *indices):
+        """vectorized get_offset
+
+        names and indices (one per dimension) are scalars or arrays,
+        broadcast against each other
+        """
+        ivar = np.vectorize(self.varindex.__getitem__, otypes=["i8"])(names)
+        return self.offset_table[indices+(ivar,)]
+
+    @property
+    def donemap_offset(self):
+        """offset of the completion map
+
+        the map has one byte per index (all dimensions) and sits at
+        the end of the header area
+        """
+        size = int(np.prod([self.dimcount[dname] for dname in self.dims]))
+        offset = self.headersize-size
+        textsize = self.header.find(LAST_LINE)+len(LAST_LINE)+1
+        assert textsize <= offset, "no room for the completion map in the header"
+        return offset
+
+    def mark_done(self, idx):
+        """mark `idx` as completed in the completion map
+
+        idx can be a partial index (e.g. only the first dimension),
+        then all the entries below it are marked
+        """
+        idx = tuple(idx) if isinstance(idx, (tuple, list)) else (idx,)
+        counts = [self.dimcount[dname] for dname in self.dims]
+        count = int(np.prod(counts[len(idx):]))
+        start = int(np.ravel_multi_index(idx, counts[:len(idx)]))*count
+        binio.write_done(self.filename, self.donemap_offset+start, count)
+
+    def read_donemap(self):
+        """return the completion map, a boolean array (one entry per idx)"""
+        counts = [self.dimcount[dname] for dname in self.dims]
+        donemap = binio.read_done(self.filename, self.donemap_offset,
+                                  int(np.prod(counts)))
+        donemap.shape = counts
+        return donemap
+
+    def missing(self):
+        """return the list of idx not yet completed"""
+        return [tuple(idx) for idx in np.argwhere(~self.read_donemap())]
+
+    def read_variable(self, name, idx, copy=False,
+                      levels=None, jslice=None, islice=None):
+        """read variable `name` at `idx`
+
+        in mmap mode the data is a read-only view on the file (no
+        copy), use copy=True to get a private writable array
+
+        levels, jslice, islice restrict the read to a hyperslab, only
+        the bytes of the selected levels, rows and columns are read
+        (see binio.hyperslab for the allowed values)
+        """
+        if self.is_compressed:
+            data = self.decompress(name, self.read_block(name, idx))
+            if (levels, jslice, islice) != (None, None, None):
+                data = hyperslab_of(data, levels, jslice, islice)
+            return self.unpack(name, data)
+
+        if (levels, jslice, islice) != (None, None, None):
+            return self.read_hyperslab(name, idx, levels, jslice, islice)
+
         offset = self.get_offset(name, idx)
         shape = self.toc[name]["shape"]
         dtype = self.toc[name]["dtype"]
         count = np.prod(shape)
-        data = np.fromfile(self.filename,
-                           count=count,
-                           offset=offset,
-                           dtype=dtype)
+        if self.use_mmap:
+            nbytes = count*np.dtype(dtype).itemsize
+            data = self.get_mmap()[offset:offset+nbytes].view(dtype)
+            if copy:
+                data = np.array(data)
+        else:
+            data = np.fromfile(self.filename,
+                               count=count,
+                               offset=offset,
+                               dtype=dtype)
         if shape is 1:
             data = data[0]
         else:
             data.shape = shape
-        return data
-
-    def get_offset(self, name, idx):
-        if self.ndims > 1:
-            assert len(idx) == self.ndims
-            baseoffset = self.headersize
-            for k in range(self.ndims):
-                dname = self.dims[k]
-                assert idx[k] < self.dimcount[dname]
-                baseoffset += +self.dimsize[dname]*idx[k]
+        return self.unpack(name, data)
+
+    def pread_variable(self, fd, name, idx, out=None, index=None):
+        """read variable `name` at `idx` from the file descriptor `fd`
+
+        positional read (os.pread) into `out` (allocated if None):
+        neither the file position nor the dataset are modified, so it
+        is safe to call it from several threads
+
+        index: the index of the compressed file of `fd` (default
+        self.index)
+        """
+        if self.is_compressed:
+            index = self.index if index is None else index
+            offset, size, _ = index[self.tableindex(name, idx)]
+            block = os.pread(fd, int(size), int(offset))
+            data = self.decompress(name, block)
+            return self.unpack(name, data, out=out)
+        offset = self.get_offset(name, idx)
+        shape = self.toc[name]["shape"]
+        dtype = self.toc[name]["dtype"]
+        if (out is None) or ("packing" in self.toc[name]):
+            data = np.empty(shape, dtype=dtype)
         else:
-            dname = self.dims[0]
-            assert idx < self.dimcount[dname]
-            baseoffset = self.headersize+self.dimsize[dname]*idx
-
-        offset = baseoffset + self.toc[name]["offset"]
-        return offset
+            data = out
+        binio.pread_into(fd, data, offset)
+        return self.unpack(name, data, out=out)
 
-    def write_variable(self, name, data, idx):
+    def read_hyperslab(self, name, idx, levels=None, jslice=None, islice=None):
+        """read a hyperslab of variable `name` at `idx`"""
         offset = self.get_offset(name, idx)
         shape = self.toc[name]["shape"]
         dtype = self.toc[name]["dtype"]
+        offsets, sizes, outshape = binio.hyperslab(shape,
+                                                   np.dtype(dtype).itemsize,
+                                                   levels, jslice, islice)
+        offsets += offset
+        if self.use_mmap:
+            mm = self.get_mmap()
+            raw = np.concatenate([mm[o:o+s]
+                                  for o, s in zip(offsets, sizes)])
+        else:
+            fd = os.open(self.filename, os.O_RDONLY)
+            try:
+                raw = binio.gather_ranges(fd, offsets, sizes)
+            finally:
+                os.close(fd)
+        data = raw.view(dtype)
+        data.shape = outshape
+        return self.unpack(name, data)
+
+    def read_variables(self, names, idx):
+        """read several variables at the same `idx`
+
+        the variables of one idx are contiguous in the file, so they
+        are read with a single read
+        """
+        return self.read_many([(name, idx) for name in names])
+
+    def read_many(self, requests, maxgap=binio.MAXGAP):
+        """read a batch of variables
+
+        Parameters
+        ----------
+        requests: list of (name, idx)
+        maxgap: int, byte ranges less than maxgap bytes apart are
+        merged and read at once
+
+        Returns
+        -------
+        list of arrays, in the order of requests
+        """
+        if self.is_compressed:
+            return [self.read_variable(name, idx) for name, idx in requests]
+        offsets = [self.get_offset(name, idx) for name, idx in requests]
+        sizes = [self.get_nbytes(name) for name, idx in requests]
+        if self.use_mmap:
+            mm = self.get_mmap()
+            chunks = [mm[offset:offset+size]
+                      for offset, size in zip(offsets, sizes)]
+        else:
+            fd = os.open(self.filename, os.O_RDONLY)
+            try:
+                chunks = binio.read_ranges(fd, offsets, sizes, maxgap)
+            finally:
+                os.close(fd)
+        return [self.frombytes(name, chunk)
+                for (name, idx), chunk in zip(requests, chunks)]
+
+    def get_nbytes(self, name):
+        shape = self.toc[name]["shape"]
+        dtype = self.toc[name]["dtype"]
+        return int(np.prod(shape))*np.dtype(dtype).itemsize
+
+    def frombytes(self, name, chunk):
+        """view the raw bytes `chunk` as variable `name`"""
+        shape = self.toc[name]["shape"]
+        dtype = self.toc[name]["dtype"]
+        data = chunk.view(dtype)
+        data.shape = shape
+        return self.unpack(name, data)
+
+    def tableindex(self, name, idx):
+        if self.ndims > 1:
+            return tuple(idx)+(self.varindex[name],)
+        else:
+            return (idx, self.varindex[name])
+
+    def get_offset(self, name, idx):
+        return int(self.offset_table[self.tableindex(name, idx)])
+
+    def write_variable(self, name, data, idx, writer=None):
+        """write variable `name` at `idx`
+
+        if `writer` (a StripeWriter) is provided, the data goes
+        through it instead of opening the file
+        """
+        data = self.pack(name, data)
+        if self.is_compressed:
+            self.write_block(name, data, idx)
+            return
+        offset = self.get_offset(name, idx)
+        if writer is not None:
+            writer.write(offset, data)
+            return
         with open(self.filename, "rb+") as fid:
             fid.seek(offset)
-            if shape == (1,):
-                data = np.asarray(data)
-            fid.write(data.astype(dtype).tobytes())
+            fid.write(data.tobytes())
+
+    def write_block(self, name, data, idx):
+        """compress and append variable `name` at `idx`
+
+        a block that is written again reuses its slot if the new
+        block fits in it (the capacity of a slot is the size of the
+        block it was created for), otherwise the file has to be
+        rewritten. See lock_for_writing for the concurrent writers.
+        """
+        codec = self.infos["compression"]["codec"]
+        level = self.infos["compression"].get("level", 1)
+        compress = codecs[codec][0]
+        dtype = self.toc[name]["dtype"]
+        block = compress(np.ascontiguousarray(data, dtype=dtype).tobytes(), level)
+        fid = self.lock_for_writing()
+        key = self.tableindex(name, idx)
+        offset, size, capacity = self.index[key]
+        if offset > 0:
+            if len(block) > capacity:
+                raise ValueError(f"the new block of {name} at {idx} "
+                                 f"({len(block)} bytes) does not fit "
+                                 f"in its slot ({capacity} bytes)")
+        else:
+            offset, capacity = self.endoffset, len(block)
+            self.endoffset += len(block)
+        fid.seek(offset)
+        fid.write(block)
+        self.index[key] = (offset, len(block), capacity)
+
+    def stripe_writer(self, background=False, callback=None):
+        """return a StripeWriter on the file
+
+        a stripe is one element of the first dimension
+        """
+        stripesize = self.dimsize[self.dims[0]]
+        return binio.StripeWriter(self.filename, stripesize,
+                                  base=self.headersize,
+                                  background=background,
+                                  callback=callback)
 
     def write_header(self):
         flag = "br+" if os.path.isfile(self.filename) else "bw"
@@ -199,18 +662,66 @@ class Dataset():
             data = np.asarray(self.header, dtype="c")
             fid.write(data.tobytes())
 
-    def allocate_empty_file(self, force=False):
+    def allocate_empty_file(self, force=False, reserve=False):
+        """create the empty file and write its header
+
+        the file is sparse unless reserve=True (see
+        binio.allocate_file). Returns the layout of the file or None
+        if nothing was done
+        """
         binfile = self.filename
         filesize = self.filesize
         if os.path.isfile(binfile):
             print(f"[WARNING] {binfile} already exists -> do nothing")
         elif (filesize <= 1024**2) or force:
-            command = f"dd if=/dev/zero of={binfile} bs=1 count=0 seek={filesize}"
-            os.system(command)
+            layout = binio.allocate_file(binfile, filesize,
+                                         header=self.header,
+                                         reserve=reserve)
+            if self.is_compressed:
+                # an empty index: the file is valid before any block
+                # is written
+                self.index[:] = 0
+                self.endoffset = self.headersize+8
+                with open(binfile, "rb+") as fid:
+                    self.dump_index(fid)
+            return layout
         else:
             print(f"[WARNING] {binfile} is too large (use force=True)")
 
 
+def get_packing(varinfos, dtype):
+    """packing parameters of a quantized variable
+
+    the default fill value is the smallest integer of dtype for
+    signed types and the largest one for unsigned types. The fill
+    value is excluded from the range of valid values.
+    """
+    iinfo = np.iinfo(dtype)
+    if "_FillValue" in varinfos:
+        fillvalue = varinfos["_FillValue"]
+    else:
+        fillvalue = iinfo.min if iinfo.min < 0 else iinfo.max
+    lo, hi = iinfo.min, iinfo.max
+    if fillvalue == lo:
+        lo += 1
+    if fillvalue == hi:
+        hi -= 1
+    return {"scale_factor": varinfos["scale_factor"],
+            "add_offset": varinfos.get("add_offset", 0.),
+            "_FillValue": fillvalue,
+            "valid_range": (lo, hi)}
+
+
+def hyperslab_of(data, levels=None, jslice=None, islice=None):
+    """apply a hyperslab selection (see binio.hyperslab) on an array"""
+    def select(index):
+        return slice(None) if index is None else index
+    if data.ndim == 3:
+        return data[select(levels), select(jslice), select(islice)]
+    else:
+        return data[select(jslice), select(islice)]
+
+
 def retrieve_headersize(filename):
     headersize = -1
     with open(filename, "br") as fid:
@@ -267,15 +778,19 @@ def convert_list_to_str(infos: dict) -> dict:
     this is to force lists and tuples to appear as a single line in
     a yaml file rather being written over as many lines as the
     number of elements
+
+    the strings of a list are double-quoted, e.g.
+
+    ["2008-09-26", "2008-09-27"]
     """
     newinfos = {}
     for key, val in infos.items():
         if isinstance(val, dict):
             newinfos[key] = convert_list_to_str(val)
-        elif isinstance(val, list):
-            newinfos[key] = f"{val}"
-        elif isinstance(val, tuple):
-            newinfos[key] = f"{list(val)}"
+        elif isinstance(val, (list, tuple)):
+            items = [f'"{v}"' if isinstance(v, str) else f"{v}"
+                     for v in val]
+            newinfos[key] = f"[{', '.join(items)}]"
         else:
             newinfos[key] = val
     return newinfos
@@ -314,7 +829,6 @@ def generate_sample(samplefile):
     print(ds.header)
     print(f"filesize: {ds.filesize} B")
     ds.allocate_empty_file()
-    ds.write_header()
 
 
 def write_sample(samplefile):
@@ -348,12 +862,32 @@ def read_sample(samplefile):
 
 
 class FastRead():
-    def __init__(self, dataset):
+    """Reader that keeps the file open
+
+    filename: the file to read (default dataset.filename), a file
+    that has the structure of dataset, the dataset is not modified
+
+    readahead: bool or dict of binio.Readahead options, if set the
+    blocks that follow the access pattern are fetched in advance
+    """
+
+    def __init__(self, dataset, filename=None, readahead=False):
         self.dataset = dataset
-        self.fid = open(dataset.filename, "br")
+        self.filename = dataset.filename if filename is None else filename
+        self.fid = open(self.filename, "br")
         self.is_open = True
+        if dataset.is_compressed:
+            # the index of this file, the dataset may be reused for
+            # another file
+            self.index = dataset.load_index(self.filename)[0]
+        self.readahead = None
+        if readahead:
+            options = readahead if isinstance(readahead, dict) else {}
+            self.readahead = binio.Readahead(self.fid.fileno(), **options)
 
     def close(self):
+        if self.readahead is not None:
+            self.readahead.close()
         self.fid.close()
         self.is_open = False
 
@@ -373,15 +907,31 @@ class FastRead():
         self.fid.seek(offset)
         self.fid.readinto(data)
 
-    def read(self, name, idx):
+    def read(self, name, idx, out=None):
+        """read `name` at `idx` into `out` (allocated if None)"""
         assert self.is_open, f"file is closed"
         offset = self.dataset.get_offset(name, idx)
         toc = self.dataset.toc
+        packed = "packing" in toc[name]
+        if self.dataset.is_compressed:
+            offset, size, _ = self.index[self.dataset.tableindex(name, idx)]
+            self.fid.seek(offset)
+            block = self.fid.read(size)
+            data = self.dataset.decompress(name, block,
+                                           out=None if packed else out)
+            return self.dataset.unpack(name, data, out=out)
         shape = toc[name]["shape"]
         dtype = toc[name]["dtype"]
-        data = np.zeros(shape, dtype=dtype)
+        if (out is None) or packed:
+            data = np.zeros(shape, dtype=dtype)
+        else:
+            data = out
         self.fid.seek(offset)
         self.fid.readinto(data)
+        if self.readahead is not None:
+            self.readahead.record(name, offset, data.nbytes)
+        if packed:
+            data = self.dataset.unpack(name, data, out=out)
         return data
 
 
@@ -423,6 +973,70 @@ class FastRead2():
         return data
 
 
+def test_compressed(filenames=["sample_c1.dat", "sample_c2.dat"]):
+    """several compressed files read through one Dataset that only
+    has their structure (the case of the regional datasets)"""
+    infos = {"headersize": 4096,
+             "compression": {"codec": "zlib"},
+             "dimensions": {"tile": 2, "hour": 3},
+             "variables": {"temp": {"shape": [4, 5], "dtype": "f"}}}
+    ref = {}
+    ds = Dataset("")
+    for k, filename in enumerate(filenames):
+        if os.path.isfile(filename):
+            os.remove(filename)
+        ds.filename = filename
+        ds.set_structure(dict(infos))
+        ds.allocate_empty_file()
+        # the blocks are not written in the same order in the files
+        idxs = [(tile, hour) for tile in range(2) for hour in range(3)]
+        idxs = idxs if k % 2 == 0 else idxs[::-1]
+        for session in [idxs[:3], idxs[3:]]:
+            committed = ds.load_index()[0]
+            for idx in session:
+                ref[(filename,)+idx] = np.random.uniform(
+                    size=(4, 5)).astype("f")
+                ds.write_variable("temp", ref[(filename,)+idx], idx)
+                # the committed index stays valid during the session
+                assert np.array_equal(ds.load_index()[0], committed)
+            if session is idxs[:3]:
+                ds.write_index()
+        # a second writer is rejected
+        other = Dataset(filename)
+        other.set_structure(dict(infos))
+        try:
+            other.lock_for_writing()
+            raise AssertionError("the file is not locked")
+        except RuntimeError:
+            pass
+        # a block that fits is rewritten in its slot, the slot keeps
+        # its capacity
+        first = ref[(filename, 0, 0)]
+        endoffset = ds.endoffset
+        ds.write_variable("temp", np.zeros((4, 5), dtype="f"), (0, 0))
+        ds.write_variable("temp", first, (0, 0))
+        assert ds.endoffset == endoffset
+        ds.write_index()
+
+    ds = Dataset(filenames[0])
+    ds.get_structure()
+    for filename in filenames:
+        ds.filename = filename
+        fastread = FastRead(ds)
+        index, _ = ds.load_index(filename)
+        for tile in range(2):
+            for hour in range(3):
+                expected = ref[(filename, tile, hour)]
+                assert np.array_equal(fastread.read("temp", (tile, hour)),
+                                      expected)
+                offset, size, _ = index[ds.tableindex("temp", (tile, hour))]
+                block = np.fromfile(filename, dtype="u1", count=size,
+                                    offset=offset)
+                assert np.array_equal(ds.decompress("temp", block), expected)
+        fastread.close()
+    print("compressed files: ok")
+
+
 if __name__ == "__main__":
 
     samplefile = "samplefile.dat"
@@ -2,7 +2,10 @@
 Various dataset classes to handle the binary *.dat files
 """
 import bBDF
+import binio
 import gigatl
+import packed
+import tsstore
 import onlineanalysis as oa
 import parameters
 from variables import Space
@@ -11,13 +14,20 @@ from variables import Space
 import multiprocessing as mp
 import subprocess
 from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import threading
 import datetime
 import os
 import pickle
+import numpy as np
 
 # mp.set_start_method("spawn")
 
 PIPE = subprocess.PIPE
+# number of indexes of compressed files kept by a RegDataset
+MAXINDEXES = 8
 
 param = parameters.Param()
 
@@ -74,17 +84,22 @@ class Dataset():
 
     the main function provided is read()
 
+    with use_mmap=True the arrays are read-only views on the files
+
     """
 
-    def __init__(self, bypass_check=False):
+    def __init__(self, bypass_check=False, use_mmap=False):
         self.subds = list(range(1, 14))
-        self.readers = {subd: RegDataset(subd, bypass_check=bypass_check)
+        self.options = {"bypass_check": bypass_check, "use_mmap": use_mmap}
+        self.readers = {subd: RegDataset(subd, bypass_check=bypass_check,
+                                         use_mmap=use_mmap)
                         for subd in self.subds}
         reader = self.readers[1]
         self.toc = reader.dataset.toc
         self.subdmap = gigatl.subdmap
         self.has_threads = False
         self.nthreads = 16
+        self.executor = None
         self._setdates()
 
     def _setdates(self):
@@ -93,25 +108,102 @@ class Dataset():
             dates = dates.union(set(reader.dates))
         self.dates = sorted(list(dates))
 
-    def read(self, args):
+    def read(self, args, copy=False, **hyperslab):
         varname, tile, hour, date = args
         subd = self.subdmap[tile]
-        return self.readers[subd].read(args)
+        return self.readers[subd].read(args, copy=copy, **hyperslab)
 
-    def pread(self, args):
-        varname, tiles, hour, date = args
-        # if not self.has_threads:
-        #     self.pool = schwimmbad.MultiPool(processes=self.nthreads+1)
-        #     self.has_treads = True
-        tasks = iter(
-            [(self.readers[self.subdmap[tile]], varname, tile, hour, date)
-             for tile in tiles])
-        # with schwimmbad.MultiPool(processes=self.nthreads) as pool:
-        with mp.get_context("spawn").Pool(processes=self.nthreads) as pool:
-            data = pool.map(read_his, tasks)
+    def read_variables(self, args):
+        """read several variables of one (tile, hour, date)
+
+        args: tuple (varnames, tile, hour, date)
+        """
+        varnames, tile, hour, date = args
+        subd = self.subdmap[tile]
+        return self.readers[subd].read_variables(args)
+
+    def read_batch(self, requests, nworkers=8, workers_per_file=2,
+                   maxgap=binio.MAXGAP):
+        """read a batch of (varname, tile, hour, date) with an IOPlanner
 
+        the report of the reads is kept in self.ioreport
+
+        Returns
+        -------
+        list of nd.array, in the order of requests
+        """
+        planner = IOPlanner(self, nworkers=nworkers,
+                            workers_per_file=workers_per_file,
+                            maxgap=maxgap)
+        data = planner.read(requests)
+        self.ioreport = planner.report
         return data
 
+    def read_hour(self, varname, tiles, hour, date, levels=None):
+        """read `varname` on several tiles at one hour (a map)
+
+        the tiles are grouped per region, each region uses its
+        hour-major file when available (see RegDataset.read_hour)
+
+        Returns
+        -------
+        list of nd.array, in the order of tiles
+        """
+        groups = {}
+        for k, tile in enumerate(tiles):
+            groups.setdefault(self.subdmap[tile], []).append(k)
+        datas = [None]*len(tiles)
+        for subd, ks in groups.items():
+            subtiles = [tiles[k] for k in ks]
+            subdatas = self.readers[subd].read_hour(varname, subtiles,
+                                                    hour, date, levels)
+            for k, data in zip(ks, subdatas):
+                datas[k] = data
+        return datas
+
+    def pread(self, args, out=None):
+        """parallel read of `varname` on several tiles
+
+        args: tuple (varname, tiles, hour, date)
+
+        the reads are done by a TilePool, started at the first call
+        and kept until close()
+
+        Returns
+        -------
+        list of nd.array, or `out` if provided
+        """
+        varname, tiles, hour, date = args
+        if not self.has_threads:
+            self.pool = TilePool("his", self.toc, nworkers=self.nthreads,
+                                 **self.options)
+            self.has_threads = True
+        return self.pool.read(varname, tiles, hour, date, out=out)
+
+    def pread_threads(self, varname, tiles, hour, date, out=None):
+        """read `varname` on several tiles with a pool of threads
+
+        the threads share the readers (positional reads, see
+        RegDataset.pread), the pool is kept for the next calls
+
+        out: optional array of shape (len(tiles),)+shape of varname
+
+        Returns
+        -------
+        list of nd.array (or out)
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.nthreads)
+
+        def read(k):
+            tile = tiles[k]
+            reader = self.readers[self.subdmap[tile]]
+            return reader.pread((varname, tile, hour, date),
+                                out=None if out is None else out[k])
+
+        data = list(self.executor.map(read, range(len(tiles))))
+        return data if out is None else out
+
     def read_tile(self, args):
         varinfos, tile = args
         varname = varinfos.varname
@@ -128,15 +220,18 @@ class Dataset():
         if self.has_threads:
             self.pool.close()
             self.has_threads = False
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def readsurf(self, args):
         varname, tile, hour, date = args
         subd = self.subdmap[tile]
-        data = self.readers[subd].read(args)
         if varname in ["u", "v", "temp", "salt", "AKv"]:
-            return data[-1]
+            # read only the top level
+            return self.readers[subd].read(args, levels=-1)
         else:
-            return data
+            return self.readers[subd].read(args)
 
     def is_datetiles_online(self, tiles, date):
         subds = set([self.subdmap[t]
@@ -162,11 +257,14 @@ class GDataset():
 
     the main function provided is read()
 
+    with use_mmap=True the arrays are read-only views on the files
+
     """
 
-    def __init__(self):
+    def __init__(self, use_mmap=False):
         self.subds = list(range(1, 14))
-        self.readers = {subd: GridRegDataset(subd)
+        self.options = {"use_mmap": use_mmap}
+        self.readers = {subd: GridRegDataset(subd, use_mmap=use_mmap)
                         for subd in self.subds}
         reader = self.readers[1]
         self.toc = reader.dataset.toc
@@ -175,28 +273,137 @@ class GDataset():
         self.nthreads = 16
         #self.pool = schwimmbad.MultiPool(processes=self.nthreads+1)
         #self.has_treads = True
+        self.dirgridcache = getattr(param, "dirgridcache",
+                                    f"{param.dirscratch}/GRIDCACHE")
+        # global mosaics, varname -> read-only memmap or None
+        self.mosaics = {}
 
     def read_tile(self, args):
         varinfos, tile = args
-        varname = varinfos.varname
-        subd = self.subdmap[tile]
-        return self.readers[subd].read(varname, tile)
+        return self.read((varinfos.varname, tile))
+
+    def read(self, args, copy=False):
+        """read a grid variable on a tile
 
-    def read(self, args):
+        if the global mosaic of the variable is cached (see
+        build_mosaic), the tile is a read-only view on it (no read)
+        """
         varname, tile = args
+        # a tile that does not exist is an error, even with a mosaic
+        subd = self.subdmap[tile]
+        mosaic = self.get_mosaic(varname)
+        if mosaic is not None:
+            ny, nx = self.toc[varname]["shape"][-2:]
+            j0, i0 = ny*(tile//100), nx*(tile % 100)
+            data = mosaic[j0:j0+ny, i0:i0+nx]
+            return np.array(data) if copy else data
+        return self.readers[subd].read(varname, tile, copy=copy)
+
+    def mosaic_filename(self, varname):
+        return f"{self.dirgridcache}/{varname}.npy"
+
+    def mosaic_dtype(self, varname):
+        """the dtype of the tiles of `varname`, as read from the files"""
+        varinfos = self.toc[varname]
+        return np.dtype("f" if "packing" in varinfos else varinfos["dtype"])
+
+    def mosaic_tileindex(self):
+        """the content of tiles.npy, (tile, jtile, itile) per tile"""
+        return np.asarray([(tile, tile//100, tile % 100)
+                           for tile in sorted(self.subdmap)])
+
+    def get_mosaic(self, varname):
+        """the cached global mosaic of `varname` or None
+
+        raise ValueError if the mosaic does not match the grid (tiles,
+        shape or dtype), the mosaics must then be rebuilt
+        """
+        if varname not in self.mosaics:
+            filename = self.mosaic_filename(varname)
+            if os.path.isfile(filename):
+                mosaic = np.load(filename, mmap_mode="r")
+                self.check_mosaic(varname, mosaic)
+                self.mosaics[varname] = mosaic
+            else:
+                self.mosaics[varname] = None
+        return self.mosaics[varname]
+
+    def check_mosaic(self, varname, mosaic):
+        msg = (f"the mosaic of {varname} in {self.dirgridcache} does not"
+               " match the grid, rebuild it with build_mosaic()")
+        tilesfile = f"{self.dirgridcache}/tiles.npy"
+        if not os.path.isfile(tilesfile):
+            raise ValueError(msg)
+        if not np.array_equal(np.load(tilesfile), self.mosaic_tileindex()):
+            raise ValueError(msg)
+        ny, nx = self.toc[varname]["shape"][-2:]
+        if mosaic.shape != (100*ny, 100*nx):
+            raise ValueError(msg)
+        if mosaic.dtype != self.mosaic_dtype(varname):
+            raise ValueError(msg)
+
+    def has_mosaic(self, varname):
+        return self.get_mosaic(varname) is not None
+
+    def build_mosaic(self, varnames=None):
+        """write the global mosaics of the 2D grid variables
+
+        one .npy file per variable in dirgridcache, tile t is at
+        [ny*(t//100):, nx*(t%100):]. The mosaic has the dtype of the
+        tiles, the tiles that do not exist are filled with NaN (0 for
+        integer variables) and are not served by read(). tiles.npy
+        lists the tiles and their position (jtile, itile) in the
+        100x100 array of tiles
+        """
+        if varnames is None:
+            varnames = [name for name, varinfos in self.toc.items()
+                        if len(varinfos["shape"]) == 2]
+        os.makedirs(self.dirgridcache, exist_ok=True)
+        tilesfile = f"{self.dirgridcache}/tiles.npy"
+        if os.path.isfile(tilesfile):
+            # the mosaics are not valid until the build is complete
+            os.remove(tilesfile)
+        for varname in varnames:
+            ny, nx = self.toc[varname]["shape"]
+            dtype = self.mosaic_dtype(varname)
+            filename = self.mosaic_filename(varname)
+            mosaic = np.lib.format.open_memmap(f"{filename}.tmp", mode="w+",
+                                               dtype=dtype,
+                                               shape=(100*ny, 100*nx))
+            mosaic[:] = np.nan if dtype.kind in "fc" else 0
+            # region by region, each grid file is read sequentially
+            for subd, reader in self.readers.items():
+                for tile in reader.tiles:
+                    print(f"\rmosaic {varname:>10} tile {tile:04}", end="")
+                    j0, i0 = ny*(tile//100), nx*(tile % 100)
+                    mosaic[j0:j0+ny, i0:i0+nx] = reader.read(varname, tile)
+            mosaic.flush()
+            del mosaic
+            os.replace(f"{filename}.tmp", filename)
+            self.mosaics.pop(varname, None)
+        print()
+        np.save(tilesfile, self.mosaic_tileindex())
+
+    def wetindex(self, tile):
         subd = self.subdmap[tile]
-        return self.readers[subd].read(varname, tile)
+        return self.readers[subd].wetindex(tile)
+
+    def pread(self, args, out=None):
+        """parallel read of `varname` on several tiles
 
-    def pread(self, args):
+        args: tuple (varname, tiles), see Dataset.pread
+        """
         varname, tiles = args
-        # if not self.has_threads:
-        #     self.pool = schwimmbad.MultiPool(processes=self.nthreads+1)
-        #     self.has_treads = True
-        tasks = [(self.readers[self.subdmap[tile]], varname, tile)
-                 for tile in tiles]
-        with schwimmbad.MultiPool(processes=self.nthreads) as pool:
-            data = pool.map(read_grid, tasks)
-        return data
+        if not self.has_threads:
+            self.pool = TilePool("grid", self.toc, nworkers=self.nthreads,
+                                 **self.options)
+            self.has_threads = True
+        return self.pool.read(varname, tiles, out=out)
+
+    def close(self):
+        if self.has_threads:
+            self.pool.close()
+            self.has_threads = False
 
 
 def read_grid(args):
@@ -204,6 +411,108 @@ def read_grid(args):
     return reader.read(varname, tile)
 
 
+class TilePool():
+    """
+    Persistent pool of workers that read tiles into shared memory
+
+    each worker builds its own reader (Dataset for kind="his",
+    GDataset for kind="grid") once, at startup. The tiles are read
+    into the slots of a shared memory tile stack allocated by the
+    parent, the workers only return (tile, slot): the arrays are
+    never pickled. The stack is kept and grown when needed.
+
+    """
+
+    def __init__(self, kind, toc, nworkers=16, **options):
+        assert kind in ["his", "grid"]
+        self.kind = kind
+        self.toc = toc
+        context = mp.get_context("spawn")
+        self.pool = context.Pool(processes=nworkers,
+                                 initializer=init_tileworker,
+                                 initargs=(kind, options))
+        self.arena = None
+
+    def get_stack(self, varname, ntiles):
+        """the tile stack (ntiles,)+shape of varname in shared memory"""
+        varinfos = self.toc[varname]
+        dtype = np.dtype("f" if "packing" in varinfos else varinfos["dtype"])
+        shape = (ntiles,)+tuple(varinfos["shape"])
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        if (self.arena is None) or (self.arena.size < nbytes):
+            self.release()
+            self.arena = shared_memory.SharedMemory(create=True,
+                                                    size=max(nbytes, 1))
+        return np.ndarray(shape, dtype=dtype, buffer=self.arena.buf)
+
+    def read(self, varname, tiles, hour=None, date=None, out=None):
+        """read `varname` on `tiles` (at hour, date for history files)
+
+        Returns
+        -------
+        list of arrays, one per tile (independent arrays, they can
+        be released separately), or `out`, an array of shape
+        (len(tiles),)+shape of varname, if provided
+        """
+        stack = self.get_stack(varname, len(tiles))
+        tasks = [(self.arena.name, stack.shape, stack.dtype.str, slot,
+                  varname, tile, hour, date)
+                 for slot, tile in enumerate(tiles)]
+        handles = self.pool.map(read_tile_into_slot, tasks)
+        if out is None:
+            out = [np.array(stack[slot]) for tile, slot in handles]
+        else:
+            for tile, slot in handles:
+                out[slot] = stack[slot]
+        del stack
+        return out
+
+    def release(self):
+        if self.arena is not None:
+            self.arena.close()
+            self.arena.unlink()
+            self.arena = None
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.release()
+
+
+# reader and shared memory attachments of a TilePool worker
+_tileworker = {}
+
+
+def init_tileworker(kind, options):
+    if kind == "his":
+        _tileworker["reader"] = Dataset(**options)
+    else:
+        _tileworker["reader"] = GDataset(**options)
+    _tileworker["kind"] = kind
+    _tileworker["arenas"] = {}
+
+
+def read_tile_into_slot(args):
+    arenaname, shape, dtype, slot, varname, tile, hour, date = args
+    arenas = _tileworker["arenas"]
+    if arenaname not in arenas:
+        # the previous stacks are no longer used by the parent
+        for arena in arenas.values():
+            arena.close()
+        arenas.clear()
+        arenas[arenaname] = shared_memory.SharedMemory(name=arenaname)
+    stack = np.ndarray(shape, dtype=dtype, buffer=arenas[arenaname].buf)
+    reader = _tileworker["reader"]
+    subd = reader.subdmap[tile]
+    if _tileworker["kind"] == "his":
+        reader.readers[subd].pread((varname, tile, hour, date),
+                                   out=stack[slot])
+    else:
+        stack[slot] = reader.readers[subd].read(varname, tile)
+    del stack
+    return tile, slot
+
+
 def read_his(args):
     reader, varname, tile, hour, date = args
     return reader.read((varname, tile, hour, date))
@@ -264,9 +573,17 @@ class RegDataset():
     the tiles handled by this object are stored in the .tiles attribute
     the dates handled by this object are stored in the .dates attribute
 
+    with use_mmap=True, read() returns read-only views on the files
+    (memory maps are kept open, one per date)
+
+    with readahead set (True or a dict of binio.Readahead options),
+    fread() fetches in advance the blocks that follow the access
+    pattern (next hour, next tile, ...)
+
     """
 
-    def __init__(self, subd, bypass_check=False):
+    def __init__(self, subd, bypass_check=False, use_mmap=False,
+                 readahead=False):
         assert 0 < subd < 14
         self.dirbin = param.dirgigaref
         self.subd = subd
@@ -275,10 +592,30 @@ class RegDataset():
         self.infos = self._get_infos()
         #self.filestatus = self._get_filestatus()
         self.set_dates_status()
-        self.dataset = bBDF.Dataset("")
+        self.dataset = bBDF.Dataset("", use_mmap=use_mmap)
         self.dataset.set_structure(self.infos)
         self.tiles = self.infos["tile"]
+        self.tileindex = {tile: k for k, tile in enumerate(self.tiles)}
         self.fastread = {}
+        self.readahead = readahead
+        # hour-major sibling files, date -> bBDF.Dataset or None
+        self.hourmajor = {}
+        # file descriptors for pread, date -> fd
+        self._fds = {}
+        self._fdlock = threading.Lock()
+        # indexes of the compressed files, LRU of date -> (stat, index)
+        self._indexes = OrderedDict()
+
+    def __getstate__(self):
+        # file descriptors and locks stay in the process
+        state = self.__dict__.copy()
+        state["_fds"] = {}
+        state.pop("_fdlock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._fdlock = threading.Lock()
 
     def set_dates_status(self):
         status = get_whole_status(verbose=False)
@@ -305,6 +642,39 @@ class RegDataset():
         assert date in self.dates
         return f"{self.dirbin}/{self.subd:02}/giga_{date}_{self.subd:02}.dat"
 
+    def use_date(self, date):
+        """point self.dataset to the file of `date`
+
+        for compressed files, the index of the file is loaded in the
+        dataset
+        """
+        self.dataset.filename = self.filename(date)
+        if self.dataset.is_compressed:
+            self.dataset.index[:] = self.get_index(date)
+
+    def get_index(self, date):
+        """the index of the compressed file of `date`
+
+        the MAXINDEXES most recently used indexes are kept, an index
+        is reloaded when the size or the mtime of its file changed
+        (e.g. a file still being converted)
+        """
+        filename = self.filename(date)
+        stat = os.stat(filename)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._fdlock:
+            if date in self._indexes:
+                cached, index = self._indexes[date]
+                if cached == signature:
+                    self._indexes.move_to_end(date)
+                    return index
+            index = self.dataset.load_index(filename)[0]
+            self._indexes[date] = (signature, index)
+            self._indexes.move_to_end(date)
+            while len(self._indexes) > MAXINDEXES:
+                self._indexes.popitem(last=False)
+            return index
+
     def _getdates(self):
         files = sorted(glob.glob(f"{self.dirbin}/{self.subd:02}/*.dat"))
         return [file.split("_")[-2] for file in files]
@@ -316,7 +686,7 @@ class RegDataset():
             return {date: is_fileonline(self.filename(date))
                     for date in self.dates}
 
-    def read(self, args):
+    def read(self, args, copy=False, levels=None, jslice=None, islice=None):
         """read a variable from a (tile, hour, date)
 
         Parameters
@@ -325,6 +695,11 @@ class RegDataset():
        args: tuple (varname, tile, hour, date). The tile must belong
        to the region. 
 
+       copy: bool, in mmap mode, return a private copy instead of a
+       read-only view on the file
+
+       levels, jslice, islice: restrict the read to a hyperslab
+
         Returns
         -------
 
@@ -332,34 +707,90 @@ class RegDataset():
 
         """
         varname, tile, hour, date = args
-        datfile = self.filename(date)
         assert self.filestatus[date] == "online"
-        self.dataset.filename = datfile
-        loc = (self.tiles.index(tile), hour)
-        return self.dataset.read_variable(varname, loc)
+        self.use_date(date)
+        loc = (self.tileindex[tile], hour)
+        return self.dataset.read_variable(varname, loc, copy=copy,
+                                          levels=levels,
+                                          jslice=jslice,
+                                          islice=islice)
+
+    def get_fd(self, date):
+        """the (cached) read-only file descriptor of `date`"""
+        with self._fdlock:
+            if date not in self._fds:
+                self._fds[date] = os.open(self.filename(date), os.O_RDONLY)
+            return self._fds[date]
+
+    def pread(self, args, out=None):
+        """thread-safe read of a variable from a (tile, hour, date)
+
+        same as read() but with a positional read on a cached file
+        descriptor, self.dataset is not modified
+
+        out: optional array where the data is read
+        """
+        varname, tile, hour, date = args
+        assert self.filestatus[date] == "online"
+        loc = (self.tileindex[tile], hour)
+        index = self.get_index(date) if self.dataset.is_compressed else None
+        return self.dataset.pread_variable(self.get_fd(date), varname, loc,
+                                           out=out, index=index)
+
+    def read_variables(self, args):
+        """read several variables from a (tile, hour, date) at once
+
+        Parameters
+        ----------
+        args: tuple (varnames, tile, hour, date)
+
+        Returns
+        -------
+        list of nd.array, one per varname
+        """
+        varnames, tile, hour, date = args
+        assert self.filestatus[date] == "online"
+        self.use_date(date)
+        loc = (self.tileindex[tile], hour)
+        return self.dataset.read_variables(varnames, loc)
 
     def read_levels(self, args):
         varname, tile, hour, date, levels = args
-        data = self.read((varname, tile, hour, date))
-        if data.ndim == 3:
-            return data[levels]
-        else:
-            return data
+        return self.read((varname, tile, hour, date), levels=levels)
 
-    def open_date(self, date):
+    def offsets(self, tiles, hours, varnames):
+        """vectorized offsets (in bytes) of (tile, hour, varname)
+
+        tiles, hours and varnames are scalars or arrays, broadcast
+        against each other
+        """
+        rows = np.vectorize(self.tileindex.__getitem__, otypes=["i8"])(tiles)
+        return self.dataset.offsets(varnames, rows, hours)
+
+    def missing(self, date):
+        """list of (tile, hour) not yet written in the file of `date`
+
+        (read from the completion map, one read for the whole file)
+        """
         self.dataset.filename = self.filename(date)
-        self.fastread[date] = bBDF.FastRead(self.dataset)
+        return [(self.tiles[itile], hour)
+                for itile, hour in self.dataset.missing()]
+
+    def open_date(self, date):
+        self.use_date(date)
+        self.fastread[date] = bBDF.FastRead(self.dataset,
+                                            readahead=self.readahead)
 
     def prefetch(self, args):
         varname, tile, hour, date = args
-        loc = (self.tiles.index(tile), hour)
+        loc = (self.tileindex[tile], hour)
         if date not in self.fastread:
             self.open_date(date)
         self.fastread[date].prefetch(varname, loc)
 
     def fread(self, args):
         varname, tile, hour, date = args
-        loc = (self.tiles.index(tile), hour)
+        loc = (self.tileindex[tile], hour)
         if date not in self.fastread:
             self.open_date(date)
         return self.fastread[date].read(varname, loc)
@@ -373,6 +804,243 @@ class RegDataset():
         dates = list(self.fastread.keys())
         for date in dates:
             self.close_date(date)
+        self.dataset.close()
+        with self._fdlock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+    def hourmajor_filename(self, date):
+        dirhourmajor = f"{param.dirscratch}/HOURMAJOR/{self.subd:02}"
+        return f"{dirhourmajor}/hourmajor_{date}_{self.subd:02}.dat"
+
+    def repack_hourmajor(self, date, varnames, levels=None):
+        """write the hour-major sibling file of `date`
+
+        in this file, all the tiles of one hour are contiguous, which
+        turns the reading of a whole map into a sequential read
+
+        Parameters
+        ----------
+        varnames: list of str, the variables to keep
+        levels: dict {varname: list of levels} for the 3D variables
+        (default all levels)
+        """
+        if levels is None:
+            levels = {}
+        variables = {}
+        for name in varnames:
+            varinfos = dict(self.infos["variables"][name])
+            shape = varinfos["shape"]
+            if len(shape) == 3:
+                varinfos["levels"] = normalize_levels(
+                    shape[0], levels.get(name, range(shape[0])))
+                varinfos["shape"] = [len(varinfos["levels"])]+shape[1:]
+            variables[name] = varinfos
+        infos = {"headersize": self.infos["headersize"],
+                 "date": date,
+                 "dimensions": {"hour": self.dataset.dimcount["hour"],
+                                "tile": len(self.tiles)},
+                 "variables": variables,
+                 "tile": self.tiles}
+        filename = self.hourmajor_filename(date)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if os.path.isfile(filename):
+            # a previous repacking, possibly with other levels
+            os.remove(filename)
+        newds = bBDF.Dataset(filename)
+        newds.set_structure(infos)
+        newds.allocate_empty_file(force=True)
+
+        # the source is read sequentially, tile by tile
+        self.use_date(date)
+        fd = os.open(filename, os.O_WRONLY)
+        try:
+            for itile, tile in enumerate(self.tiles):
+                for hour in range(infos["dimensions"]["hour"]):
+                    datas = self.dataset.read_variables(
+                        varnames, (itile, hour))
+                    for name, data in zip(varnames, datas):
+                        if "levels" in variables[name]:
+                            data = data[variables[name]["levels"]]
+                        offset = newds.get_offset(name, (hour, itile))
+                        binio.pwrite_from(fd, newds.pack(name, data), offset)
+        finally:
+            os.close(fd)
+        self.hourmajor.pop(date, None)
+        return newds
+
+    def get_hourmajor(self, date):
+        """the hour-major bBDF.Dataset of `date` or None"""
+        if date not in self.hourmajor:
+            filename = self.hourmajor_filename(date)
+            if os.path.isfile(filename):
+                ds = bBDF.Dataset(filename, use_mmap=self.dataset.use_mmap)
+                ds.get_structure()
+                self.hourmajor[date] = ds
+            else:
+                self.hourmajor[date] = None
+        return self.hourmajor[date]
+
+    def hourmajor_selection(self, date, varname, levels=None):
+        """the hour-major dataset of `date` and the selection of
+        `levels` in it
+
+        returns (None, None) if there is no hour-major file or if it
+        does not have the requested levels
+        """
+        ds = self.get_hourmajor(date)
+        if (ds is None) or (varname not in ds.toc):
+            return None, None
+        stored = ds.infos["variables"][varname].get("levels")
+        if stored is None:
+            return ds, levels
+        nz = self.dataset.toc[varname]["shape"][0]
+        positions = level_positions(nz, stored, levels)
+        if positions is None:
+            return None, None
+        elif (np.ndim(positions) == 1
+              and positions == list(range(len(stored)))):
+            return ds, None
+        else:
+            return ds, positions
+
+    def read_hour(self, varname, tiles, hour, date, levels=None):
+        """read `varname` on several tiles at one hour
+
+        the hour-major sibling file is used if it exists and contains
+        the requested levels (sequential read), otherwise the
+        tile-major file is read
+
+        Returns
+        -------
+        list of nd.array, one per tile
+        """
+        ds, sel = self.hourmajor_selection(date, varname, levels)
+        if ds is not None:
+            requests = [(varname, (hour, self.tileindex[tile]))
+                        for tile in tiles]
+            datas = ds.read_many(requests)
+            if sel is not None:
+                datas = [data[sel] for data in datas]
+            return datas
+        self.use_date(date)
+        locs = [(self.tileindex[tile], hour) for tile in tiles]
+        if levels is None:
+            return self.dataset.read_many([(varname, loc) for loc in locs])
+        else:
+            return [self.dataset.read_variable(varname, loc, levels=levels)
+                    for loc in locs]
+
+    def tsstore_filename(self, varname, dates):
+        dirts = f"{param.dirscratch}/TSSTORE/{self.subd:02}"
+        return f"{dirts}/ts_{varname}_{dates[0]}_{dates[-1]}_{self.subd:02}.dat"
+
+    def build_tsstore(self, varname, dates, tiles=None, iblk=15):
+        """write the time-innermost store of `varname` over `dates`
+
+        (see tsstore.py) all the levels of a (tile, date, hour) are
+        read at once, unless the tile does not fit in the buffer
+        """
+        if tiles is None:
+            tiles = self.tiles
+        shape = self.dataset.toc[varname]["shape"]
+
+        def read(varname, tile, date, hour, levels):
+            levels = levels if len(shape) == 3 else None
+            return self.read((varname, tile, hour, date), levels=levels)
+
+        filename = self.tsstore_filename(varname, dates)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        nhours = self.dataset.dimcount["hour"]
+        return tsstore.build(read, varname, tiles, dates, shape, filename,
+                             nhours=nhours, iblk=iblk)
+
+    def open_tsstore(self, varname, dates):
+        """the TimeSeriesStore of `varname` over `dates`"""
+        store = tsstore.TimeSeriesStore(
+            self.tsstore_filename(varname, dates))
+        store.get_structure()
+        return store
+
+    def packed_filename(self, date):
+        dirpacked = f"{param.dirscratch}/PACKED/{self.subd:02}"
+        return f"{dirpacked}/packed_{date}_{self.subd:02}.dat"
+
+    def repack(self, date, gridreader, varnames=None):
+        """write the ocean-only packed file of `date`
+
+        gridreader: GridRegDataset of the same region (for the wet
+        indices)
+        """
+        if varnames is None:
+            varnames = list(self.dataset.toc)
+        variables = {name: {"shape": list(self.dataset.toc[name]["shape"]),
+                            "dtype": "f"}
+                     for name in varnames
+                     if len(self.dataset.toc[name]["shape"]) >= 2}
+        wetindices = {tile: gridreader.wetindex(tile) for tile in self.tiles}
+
+        def read(varname, tile, hour):
+            return self.read((varname, tile, hour, date))
+
+        filename = self.packed_filename(date)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        nhours = self.dataset.dimcount["hour"]
+        return packed.repack(read, self.tiles, wetindices, variables,
+                             filename, nhours=nhours)
+
+    def open_packed(self, date, use_mmap=False):
+        """the PackedDataset of `date` (see repack)"""
+        ds = packed.PackedDataset(self.packed_filename(date),
+                                  use_mmap=use_mmap)
+        ds.get_structure()
+        return ds
+
+
+def normalize_levels(nz, levels):
+    """the sorted list of distinct levels, in range(nz), of `levels`
+
+    levels: int or list of int, negative levels count from the top
+    """
+    selected = np.arange(nz)[np.atleast_1d(levels)]
+    return sorted(set(selected.tolist()))
+
+
+def level_positions(nz, stored, levels=None):
+    """positions of `levels` among the `stored` levels
+
+    the stored levels are those of an hour-major file (in the order
+    of the file). Returns an int if levels is an int, a list otherwise
+    (levels=None is all the levels), None if a level is not stored
+    """
+    stored = np.arange(nz)[np.atleast_1d(stored)].tolist()
+    position = {level: k for k, level in enumerate(stored)}
+    wanted = np.arange(nz)[slice(None) if levels is None else levels]
+    if not all(level in position for level in np.atleast_1d(wanted)):
+        return None
+    if np.ndim(wanted) == 0:
+        return position[int(wanted)]
+    else:
+        return [position[level] for level in wanted.tolist()]
+
+
+def test_level_positions():
+    nz = 5
+    stored = normalize_levels(nz, [4, 0, -1])
+    assert stored == [0, 4]
+    assert level_positions(nz, stored, 0) == 0
+    assert level_positions(nz, stored, 4) == 1
+    assert level_positions(nz, stored, -1) == 1
+    assert level_positions(nz, stored, [-1, 0]) == [1, 0]
+    assert level_positions(nz, stored, 2) is None
+    assert level_positions(nz, stored) is None
+    # files written with unsorted or negative levels
+    assert level_positions(nz, [4, 0], 0) == 1
+    assert level_positions(nz, [-1], 4) == 0
+    assert level_positions(nz, [-1]) is None
+    assert level_positions(1, [-1]) == [0]
+    print("level positions: ok")
 
 
 class GridRegDataset():
@@ -380,18 +1048,21 @@ class GridRegDataset():
 
     the main function provided is read()
 
+    with use_mmap=True, read() returns read-only views on the file
+
     """
 
-    def __init__(self, subd):
+    def __init__(self, subd, use_mmap=False):
         self.dirgrid = param.dirgrid
         self.subd = subd
         self.filename = f"{self.dirgrid}/{subd:02}/grd_gigatl1_{subd:02}.dat"
         self.infos = bBDF.read_infos(self.filename)
-        self.dataset = bBDF.Dataset(self.filename)
+        self.dataset = bBDF.Dataset(self.filename, use_mmap=use_mmap)
         self.dataset.set_structure(self.infos)
         self.tiles = self.infos["tiles"]
+        self.tileindex = {tile: k for k, tile in enumerate(self.tiles)}
 
-    def read(self, varname, tile):
+    def read(self, varname, tile, copy=False):
         """
         Read a variable from the grid
 
@@ -400,12 +1071,260 @@ class GridRegDataset():
 
         varname: str the name of the variable
         tile: int the tile
+        copy: bool, in mmap mode, return a private copy instead of a
+        read-only view on the file
 
         Returns
         -------
         variable: nd.array, the data
         """
-        assert tile in self.tiles
-        index = self.tiles.index(tile)
+        assert tile in self.tileindex
+        index = self.tileindex[tile]
         loc = (index // 100, index % 100)
-        return self.dataset.read_variable(varname, loc)
+        return self.dataset.read_variable(varname, loc, copy=copy)
+
+    def wetindex(self, tile):
+        """flat indices of the wet points of `tile` (see packed.py)
+
+        read from the grid file, or computed from mask_rho for the
+        grid files without the "wetindex" variable
+        """
+        if "wetindex" in self.dataset.toc:
+            return packed.strip_wetindex(self.read("wetindex", tile))
+        else:
+            return packed.wet_index(self.read("mask_rho", tile))
+
+
+class IOPlanner():
+    """
+    Plan and execute a batch of reads (varname, tile, hour, date)
+
+    the requests are grouped by file and sorted by offset (elevator
+    order), ranges closer than maxgap bytes are merged. The ranges of
+    a file are split into at most workers_per_file contiguous parts,
+    the parts are read by a pool of nworkers threads (positional
+    reads). The results are returned in the order of the requests.
+
+    self.report compares the planned and the actual bytes and seeks
+
+    """
+
+    def __init__(self, dataset, nworkers=8, workers_per_file=2,
+                 maxgap=binio.MAXGAP):
+        self.dataset = dataset
+        self.nworkers = nworkers
+        self.workers_per_file = workers_per_file
+        self.maxgap = maxgap
+        self.report = {}
+
+    def plan(self, requests):
+        """group the requests per file and merge their byte ranges
+
+        Returns
+        -------
+        plan: dict, filename -> (bBDF.Dataset, entries, ranges, where)
+        with entries the list of (krequest, varname, offset, size)
+        sorted by offset and ranges, where as in binio.merge_ranges
+        """
+        groups = {}
+        for krequest, (varname, tile, hour, date) in enumerate(requests):
+            reader = self.dataset.readers[self.dataset.subdmap[tile]]
+            filename = reader.filename(date)
+            ds = reader.dataset
+            loc = (reader.tileindex[tile], hour)
+            if ds.is_compressed:
+                # the shared dataset of a region only has the structure
+                block = reader.get_index(date)[ds.tableindex(varname, loc)]
+                offset, size = int(block[0]), int(block[1])
+            else:
+                offset = ds.get_offset(varname, loc)
+                size = ds.get_nbytes(varname)
+            if filename not in groups:
+                groups[filename] = (ds, [])
+            groups[filename][1].append((krequest, varname, offset, size))
+
+        plan = {}
+        for filename, (ds, entries) in groups.items():
+            entries = sorted(entries, key=lambda entry: entry[2])
+            ranges, where = binio.merge_ranges([e[2] for e in entries],
+                                               [e[3] for e in entries],
+                                               self.maxgap)
+            plan[filename] = (ds, entries, ranges, where)
+
+        self.report = {
+            "requests": len(requests),
+            "files": len(plan),
+            "requested_bytes": sum(e[3] for _, entries, _, _ in plan.values()
+                                   for e in entries),
+            "planned_bytes": sum(size for _, _, ranges, _ in plan.values()
+                                 for _, size in ranges),
+            "planned_seeks": sum(len(ranges) for _, _, ranges, _
+                                 in plan.values())}
+        return plan
+
+    def read(self, requests):
+        """read the requests, returns a list of arrays in their order"""
+        plan = self.plan(requests)
+        results = [None]*len(requests)
+        jobs = []
+        for filename, (ds, entries, ranges, where) in plan.items():
+            nparts = max(1, min(self.workers_per_file, len(ranges)))
+            bounds = np.linspace(0, len(ranges), nparts+1).astype(int)
+            for r0, r1 in zip(bounds[:-1], bounds[1:]):
+                jobs += [(filename, ds, entries, ranges, where, r0, r1)]
+
+        def work(job):
+            filename, ds, entries, ranges, where, r0, r1 = job
+            nbytes, nseeks, position = 0, 0, None
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                buffers = {}
+                for krange in range(r0, r1):
+                    start, size = ranges[krange]
+                    buffer = np.empty((size,), dtype="u1")
+                    binio.pread_into(fd, buffer, start)
+                    buffers[krange] = buffer
+                    nseeks += int(start != position)
+                    position = start+size
+                    nbytes += size
+            finally:
+                os.close(fd)
+            for entry, (krange, shift) in zip(entries, where):
+                krequest, varname, offset, size = entry
+                if krange in buffers:
+                    chunk = buffers[krange][shift:shift+size]
+                    results[krequest] = decode(ds, varname, chunk)
+            return nbytes, nseeks
+
+        with ThreadPoolExecutor(max_workers=self.nworkers) as executor:
+            counts = list(executor.map(work, jobs))
+        self.report["actual_bytes"] = sum(c[0] for c in counts)
+        self.report["actual_seeks"] = sum(c[1] for c in counts)
+        return results
+
+    def summary(self):
+        report = self.report
+        lines = [f"{report['requests']} requests in {report['files']} files"]
+        lines += [f"bytes: requested {report['requested_bytes']}"
+                  f" planned {report['planned_bytes']}"
+                  f" actual {report.get('actual_bytes', '-')}"]
+        lines += [f"seeks: planned {report['planned_seeks']}"
+                  f" actual {report.get('actual_seeks', '-')}"]
+        return "\n".join(lines)
+
+
+def decode(ds, varname, chunk):
+    """array of `varname` from its raw bytes (compressed or not)"""
+    if ds.is_compressed:
+        return ds.unpack(varname, ds.decompress(varname, chunk))
+    else:
+        return ds.frombytes(varname, chunk)
+
+
+class TimeDataset():
+    """
+    Virtual dataset with a continuous time axis over the daily files
+
+    the time index t corresponds to (date, hour) = self.times[t]
+
+    ds = TimeDataset(Dataset())
+    data = ds["temp"][t0:t1, tile]         # (nt, nz, ny, nx)
+    data = ds["zeta"][t0:t1, [t1, t2, t3]] # (nt, ntiles, ny, nx)
+
+    the blocks are read in file order (per region and date, by
+    increasing offset) with FastRead handles. The handles are kept in
+    a LRU of at most maxopen open files.
+
+    """
+
+    def __init__(self, dataset, dates=None, maxopen=16):
+        self.dataset = dataset
+        self.dates = sorted(dataset.dates if dates is None else dates)
+        reader = next(iter(dataset.readers.values()))
+        self.toc = reader.dataset.toc
+        self.nhours = reader.dataset.dimcount["hour"]
+        self.times = [(date, hour)
+                      for date in self.dates
+                      for hour in range(self.nhours)]
+        self.maxopen = maxopen
+        self.handles = OrderedDict()
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, varname):
+        assert varname in self.toc
+        return TimeVariable(self, varname)
+
+    def handle(self, subd, date):
+        """the FastRead of (subd, date), opened if needed"""
+        key = (subd, date)
+        if key in self.handles:
+            self.handles.move_to_end(key)
+        else:
+            if len(self.handles) >= self.maxopen:
+                _, fastread = self.handles.popitem(last=False)
+                fastread.close()
+            reader = self.dataset.readers[subd]
+            assert reader.filestatus[date] == "online"
+            self.handles[key] = bBDF.FastRead(reader.dataset,
+                                              filename=reader.filename(date),
+                                              readahead=reader.readahead)
+        return self.handles[key]
+
+    def read(self, varname, times, tiles):
+        """read `varname` at the time indices `times` on `tiles`
+
+        Returns
+        -------
+        array of shape (len(times), len(tiles))+shape of varname
+        """
+        varinfos = self.toc[varname]
+        dtype = "f" if "packing" in varinfos else varinfos["dtype"]
+        data = np.zeros((len(times), len(tiles))+varinfos["shape"],
+                        dtype=dtype)
+        requests = []
+        for kt, t in enumerate(times):
+            date, hour = self.times[t]
+            for ktile, tile in enumerate(tiles):
+                subd = self.dataset.subdmap[tile]
+                reader = self.dataset.readers[subd]
+                loc = (reader.tileindex[tile], hour)
+                if reader.dataset.is_compressed:
+                    # the blocks are in (tile, hour) order
+                    offset = 0
+                else:
+                    offset = reader.dataset.get_offset(varname, loc)
+                requests += [(subd, date, offset, loc, kt, ktile)]
+        # file order
+        for subd, date, offset, loc, kt, ktile in sorted(requests):
+            self.handle(subd, date).read(varname, loc, out=data[kt, ktile])
+        return data
+
+    def close(self):
+        for fastread in self.handles.values():
+            fastread.close()
+        self.handles.clear()
+
+
+class TimeVariable():
+    """one variable of a TimeDataset, indexed by [time, tile]"""
+
+    def __init__(self, timedataset, varname):
+        self.timedataset = timedataset
+        self.varname = varname
+
+    def __getitem__(self, key):
+        tsel, tilesel = key
+        times = range(len(self.timedataset))[tsel]
+        tiles = tilesel if np.ndim(tilesel) > 0 else [tilesel]
+        data = self.timedataset.read(self.varname,
+                                     np.atleast_1d(times), tiles)
+        if np.ndim(times) == 0:
+            data = data[0]
+            if np.ndim(tilesel) == 0:
+                data = data[0]
+        elif np.ndim(tilesel) == 0:
+            data = data[:, 0]
+        return data
+
@@ -0,0 +1,425 @@
+"""
+Low-level positional I/O for the binary *.dat files (bBDF, RGDF)
+
+the functions work on byte ranges (offset, size) and on raw file
+descriptors, they never move a file position
+"""
+import numpy as np
+import os
+import queue
+import threading
+from collections import OrderedDict, deque
+
+# two ranges separated by less than MAXGAP bytes are read at once
+MAXGAP = 64*1024
+
+
+def merge_ranges(offsets, sizes, maxgap=MAXGAP):
+    """ Merge byte ranges into larger contiguous ranges
+
+    Parameters
+    ----------
+    offsets, sizes: lists of int, the byte ranges
+    maxgap: int, ranges separated by less than maxgap bytes are
+    merged (the hole is read and discarded)
+
+    Returns
+    -------
+    ranges: list of (start, size), the merged ranges sorted by offset
+    where: list of (rangeindex, shift), for each input range
+    """
+    order = np.argsort(offsets, kind="stable")
+    ranges = []
+    where = [None]*len(offsets)
+    for k in order:
+        offset, size = int(offsets[k]), int(sizes[k])
+        if (len(ranges) > 0) and (offset <= sum(ranges[-1])+maxgap):
+            start, length = ranges[-1]
+            ranges[-1] = (start, max(length, offset+size-start))
+        else:
+            ranges += [(offset, size)]
+        where[k] = (len(ranges)-1, offset-ranges[-1][0])
+    return ranges, where
+
+
+def pread_into(fd, buffer, offset):
+    """ Fill `buffer` with the bytes of `fd` starting at `offset` """
+    view = memoryview(buffer).cast("B")
+    nread = 0
+    while nread < len(view):
+        if hasattr(os, "preadv"):
+            n = os.preadv(fd, [view[nread:]], offset+nread)
+        else:
+            chunk = os.pread(fd, len(view)-nread, offset+nread)
+            n = len(chunk)
+            view[nread:nread+n] = chunk
+        if n == 0:
+            raise EOFError(f"cannot read {len(view)} B at offset {offset}")
+        nread += n
+
+
+def pwrite_from(fd, buffer, offset):
+    """ Write the whole `buffer` in `fd` starting at `offset` """
+    view = memoryview(buffer).cast("B")
+    nwritten = 0
+    while nwritten < len(view):
+        nwritten += os.pwrite(fd, view[nwritten:], offset+nwritten)
+
+
+def allocate_file(filename, filesize, header=None, reserve=False):
+    """ Create a file of `filesize` bytes without writing its data
+
+    Parameters
+    ----------
+    filename: str, the file should not exist
+    filesize: int, in bytes
+    header: str or bytes, written at the beginning of the file
+    reserve: bool, if False the file is sparse (ftruncate), if True
+    the disk blocks are reserved (posix_fallocate), which avoids
+    fragmentation when the file is filled later
+
+    Returns
+    -------
+    layout: dict with the filename, the filesize, the headersize and
+    the number of bytes actually allocated on disk
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        if reserve and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, filesize)
+        else:
+            os.ftruncate(fd, filesize)
+        headersize = 0
+        if header is not None:
+            if isinstance(header, str):
+                header = header.encode()
+            pwrite_from(fd, header, 0)
+            headersize = len(header)
+        stat = os.fstat(fd)
+    finally:
+        os.close(fd)
+    return {"filename": filename,
+            "filesize": stat.st_size,
+            "headersize": headersize,
+            "allocated": stat.st_blocks*512}
+
+
+def layout_summary(layout):
+    """ One-line description of a layout returned by allocate_file """
+    return (f"{layout['filename']}: {layout['filesize']} B"
+            f" (header {layout['headersize']} B,"
+            f" {layout['allocated']} B allocated on disk)")
+
+
+# value of a completed entry in a completion map
+DONE = 1
+
+
+def write_done(filename, offset, count):
+    """ Mark `count` entries of a completion map as done
+
+    the entries are written with a single pwrite, so concurrent
+    writers of different entries never interfere
+    """
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        pwrite_from(fd, bytes([DONE])*count, offset)
+    finally:
+        os.close(fd)
+
+
+def read_done(filename, offset, count):
+    """ Read a completion map, returns a boolean array """
+    donemap = np.fromfile(filename, dtype="u1", count=count, offset=offset)
+    return donemap == DONE
+
+
+def read_ranges(fd, offsets, sizes, maxgap=MAXGAP):
+    """ Read several byte ranges with one read per merged range
+
+    Returns
+    -------
+    chunks: list of uint8 arrays, one per input range (in the input
+    order), they are views on the merged buffers
+    """
+    ranges, where = merge_ranges(offsets, sizes, maxgap)
+    buffers = []
+    for start, size in ranges:
+        buffer = np.empty((size,), dtype="u1")
+        pread_into(fd, buffer, start)
+        buffers += [buffer]
+    return [buffers[k][shift:shift+size]
+            for (k, shift), size in zip(where, sizes)]
+
+
+def gather_ranges(fd, offsets, sizes, maxgap=MAXGAP):
+    """ Read byte ranges and concatenate them in a single uint8 array """
+    chunks = read_ranges(fd, offsets, sizes, maxgap)
+    return np.concatenate(chunks)
+
+
+def hyperslab(shape, itemsize, levels=None, jslice=None, islice=None):
+    """ Byte ranges of a hyperslab of a C-ordered (nz, ny, nx) or (ny, nx) array
+
+    Parameters
+    ----------
+    shape: tuple, the shape of the full array
+    itemsize: int, the size in bytes of one element
+    levels, jslice, islice: None, int, slice or list of indices. An
+    int removes the dimension (like numpy indexing). `islice` must
+    select contiguous indices. `levels` is ignored for 2D arrays.
+
+    Returns
+    -------
+    offsets: array of int, offsets relative to the start of the array
+    sizes: array of int, one per offset
+    outshape: tuple, the shape of the hyperslab
+    """
+    ny, nx = shape[-2:]
+    outshape = ()
+    if len(shape) == 3:
+        ks = np.arange(shape[0])[slice(None) if levels is None else levels]
+        if np.ndim(ks) > 0:
+            outshape += (len(ks),)
+    else:
+        ks = 0
+    js = np.arange(ny)[slice(None) if jslice is None else jslice]
+    if np.ndim(js) > 0:
+        outshape += (len(js),)
+    ii = np.arange(nx)[slice(None) if islice is None else islice]
+    if np.ndim(ii) > 0:
+        outshape += (len(ii),)
+        if np.any(np.diff(ii) != 1):
+            raise ValueError("islice should select contiguous indices")
+    ii = np.atleast_1d(ii)
+    i0, ni = ii[0], len(ii)
+    ks = np.atleast_1d(ks)
+    js = np.atleast_1d(js)
+
+    if (ni == nx) and np.all(np.diff(js) == 1):
+        # whole rows: one range per level
+        offsets = (ks*ny+js[0])*nx
+        sizes = np.full(offsets.shape, len(js)*nx)
+    else:
+        offsets = ((ks[:, np.newaxis]*ny+js[np.newaxis, :])*nx+i0).ravel()
+        sizes = np.full(offsets.shape, ni)
+    return offsets*itemsize, sizes*itemsize, outshape
+
+
+class StripeWriter():
+    """ Write a file stripe by stripe
+
+    The writes are assembled in a buffer of buffersize bytes (default
+    stripesize) and written with a single pwrite. The buffer holds a
+    window of one stripe, starting at the first write after a flush.
+    It is flushed when a write falls outside the window (another
+    stripe, before the window or beyond buffersize) and on flush() or
+    close(). Stripe k covers the bytes [base+k*stripesize,
+    base+(k+1)*stripesize) of the file. Only the written bytes are
+    written: the holes between the writes of a window are skipped
+    (one pwrite per contiguous run).
+
+    Sequential writes (increasing offsets) make the best use of the
+    buffer. A writer can be kept open and reused for many stripes.
+
+    With background=True, a thread writes the windows while the next
+    one is assembled (two buffers are used). wait() blocks until
+    everything flushed is on disk.
+
+    callback(stripe) is called each time a window of the stripe is
+    written.
+    """
+
+    def __init__(self, filename, stripesize, base=0,
+                 background=False, callback=None, buffersize=None):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY)
+        self.stripesize = stripesize
+        self.buffersize = stripesize if buffersize is None else buffersize
+        self.base = base
+        self.background = background
+        self.callback = callback
+        # the buffers are allocated on first use
+        self.free = queue.Queue()
+        nbuffers = 2 if background else 1
+        for k in range(nbuffers):
+            self.free.put(None)
+        self.buffer = None
+        self.stripe = None
+        self.error = None
+        if background:
+            self.pending = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, offset, data):
+        """ Write the array `data` at `offset` (in bytes) """
+        raw = np.ascontiguousarray(data).reshape(-1).view("u1")
+        stripe, start = divmod(offset-self.base, self.stripesize)
+        end = start+len(raw)
+        assert end <= self.stripesize, "data overlaps two stripes"
+        if len(raw) > self.buffersize:
+            # too large to be buffered
+            self.flush()
+            self.wait()
+            pwrite_from(self.fd, raw, offset)
+            return
+        if ((stripe != self.stripe) or (start < self.lo)
+                or (end > self.lo+self.buffersize)):
+            self.flush()
+            self.buffer = self.free.get()
+            if self.buffer is None:
+                self.buffer = np.empty((self.buffersize,), dtype="u1")
+            self.stripe = stripe
+            self.lo = start
+            self.runs = []
+        self.buffer[start-self.lo:end-self.lo] = raw
+        last = self.runs[-1] if len(self.runs) > 0 else None
+        if (last is not None) and (last[0] <= start <= last[1]):
+            last[1] = max(last[1], end)
+        else:
+            self.runs += [[start, end]]
+
+    def flush(self):
+        """ Write the current window """
+        if self.buffer is None:
+            return
+        job = (self.buffer, self.stripe, self.lo, merge_runs(self.runs))
+        if self.background:
+            self.pending.put(job)
+        else:
+            self._write(job)
+        self.buffer = None
+        self.stripe = None
+
+    def wait(self):
+        """ Block until the flushed windows are written """
+        if self.background:
+            self.pending.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        if self.background:
+            self.pending.put(None)
+            self.thread.join()
+        os.close(self.fd)
+        if self.error is not None:
+            raise self.error
+
+    def _write(self, job):
+        buffer, stripe, lo, runs = job
+        for start, end in runs:
+            offset = self.base+stripe*self.stripesize+start
+            pwrite_from(self.fd, buffer[start-lo:end-lo], offset)
+        self.free.put(buffer)
+        if self.callback is not None:
+            self.callback(stripe)
+
+    def _run(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                self.pending.task_done()
+                break
+            try:
+                self._write(job)
+            except Exception as error:
+                self.error = error
+                self.free.put(job[0])
+            self.pending.task_done()
+
+
+def merge_runs(runs):
+    """ the sorted union of the [start, end) runs """
+    merged = []
+    for start, end in sorted(runs):
+        if (len(merged) > 0) and (start <= merged[-1][1]):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged += [[start, end]]
+    return merged
+
+
+class Readahead():
+    """ Adaptive readahead driven by the access pattern
+
+    record() is called for each read. The reads are grouped by key
+    (e.g. the variable name). When the last two strides of a key are
+    equal (next hour, next tile, same hour across tiles...) the next
+    blocks along that stride are fetched in advance: announced to
+    the kernel with posix_fadvise(WILLNEED), or read by a background
+    thread if use_thread=True (or if fadvise is not available).
+
+    Parameters
+    ----------
+    fd: int, the file descriptor
+    depth: int, the maximum number of blocks fetched ahead
+    budget: int, the maximum number of bytes fetched ahead
+    """
+
+    def __init__(self, fd, depth=4, budget=256*1024**2, use_thread=False):
+        self.fd = fd
+        self.depth = depth
+        self.budget = budget
+        self.use_thread = use_thread or not hasattr(os, "posix_fadvise")
+        self.history = {}
+        # recently fetched offsets, to avoid fetching a block twice
+        self.fetched = OrderedDict()
+        if self.use_thread:
+            self.pending = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def record(self, key, offset, nbytes):
+        """ Record a read of `nbytes` at `offset` and fetch ahead """
+        history = self.history.setdefault(key, deque(maxlen=3))
+        history.append(offset)
+        if len(history) < 3:
+            return
+        stride = history[2]-history[1]
+        if (stride != 0) and (stride == history[1]-history[0]):
+            depth = min(self.depth, self.budget // max(nbytes, 1))
+            for k in range(1, depth+1):
+                nextoffset = offset+k*stride
+                if nextoffset < 0:
+                    break
+                if nextoffset not in self.fetched:
+                    self._fetch(nextoffset, nbytes)
+
+    def close(self):
+        if self.use_thread:
+            self.pending.put(None)
+            self.thread.join()
+
+    def _fetch(self, offset, nbytes):
+        self.fetched[offset] = nbytes
+        if len(self.fetched) > 16*self.depth:
+            self.fetched.popitem(last=False)
+        if self.use_thread:
+            self.pending.put((offset, nbytes))
+        else:
+            os.posix_fadvise(self.fd, offset, nbytes,
+                             os.POSIX_FADV_WILLNEED)
+
+    def _run(self):
+        buffer = np.empty((0,), dtype="u1")
+        while True:
+            job = self.pending.get()
+            if job is None:
+                break
+            offset, nbytes = job
+            if len(buffer) < nbytes:
+                buffer = np.empty((nbytes,), dtype="u1")
+            try:
+                pread_into(self.fd, buffer[:nbytes], offset)
+            except (OSError, EOFError):
+                # beyond the end of the file or closed file
+                pass
@@ -1,6 +1,8 @@
 import xarray as xr
 import numpy as np
 import bBDF
+import binio
+import packed
 import glob
 import os
 
@@ -26,7 +28,6 @@ def get_infos(subd):
     ds = xr.load_dataset(grdfile)
 
     headersize = 29400
-    stripes = {"size": 177848320, "roundingsize": 1024}
 
     dims = {"chunk": ntiles//100+1, "tile": 100}
     attrs = ds.attrs
@@ -50,6 +51,19 @@ def get_infos(subd):
                 vattrs[key] = int(value)
         variables[name].update(vattrs)
 
+    # flat indices of the wet points, padded with -1, for the packed
+    # (ocean-only) history files
+    ny, nx = ds.variables["mask_rho"].shape
+    variables["wetindex"] = {"shape": [ny*nx], "dtype": "int16",
+                             "long_name": "flat index of the wet points"}
+
+    # a stripe is a chunk of 100 tiles, its size follows the variables
+    tilesize = sum(np.dtype(v["dtype"]).itemsize*int(np.prod(v["shape"]))
+                   for v in variables.values())
+    roundingsize = 1024
+    stripes = {"size": bBDF.roundup(tilesize*dims["tile"], roundingsize),
+               "roundingsize": roundingsize}
+
     infos = {}
     infos["headersize"] = headersize
     infos["stripes"] = stripes
@@ -60,13 +74,13 @@ def get_infos(subd):
     return infos
 
 
-def allocate_empty_binfile(binfile, filesize):
+def allocate_empty_binfile(binfile, filesize, header=None, reserve=False):
     if os.path.isfile(binfile):
         print(f"Warning {binfile} already exist")
     else:
-        command = f"dd if=/dev/zero of={binfile} bs=1 count=0 seek={filesize}"
-        print(command)
-        os.system(command)
+        layout = binio.allocate_file(binfile, filesize,
+                                     header=header, reserve=reserve)
+        print(f"allocate {binio.layout_summary(layout)}")
 
 
 def convert_grd(subd):
@@ -77,22 +91,28 @@ def convert_grd(subd):
     newds.set_structure(infos)
 
     # os.remove(target_grid)
-    allocate_empty_binfile(target_grid, newds.filesize)
-    newds.write_header()
+    allocate_empty_binfile(target_grid, newds.filesize, header=newds.header)
 
     tiles = infos["tiles"]
 
-    for k in range(len(tiles)):
-        tile = tiles[k]
-        idx = (k//100, k % 100)
-
-        grdfile = f"{dirgrid}/{subd:02}/gigatl1_grd_masked.{tile:04}.nc"
-        ds = xr.open_dataset(grdfile)
-
-        for name in infos["variables"]:
-            print(f"\rtile {tile:04} {name:>20}", end="")
-            data = np.asarray(ds.variables[name][:])
-            newds.write_variable(name, data, idx)
+    # one stripe (chunk of 100 tiles) is written at once
+    with newds.stripe_writer() as writer:
+        for k in range(len(tiles)):
+            tile = tiles[k]
+            idx = (k//100, k % 100)
+
+            grdfile = f"{dirgrid}/{subd:02}/gigatl1_grd_masked.{tile:04}.nc"
+            ds = xr.open_dataset(grdfile)
+
+            for name in infos["variables"]:
+                print(f"\rtile {tile:04} {name:>20}", end="")
+                if name == "wetindex":
+                    mask = np.asarray(ds.variables["mask_rho"][:])
+                    data = packed.pad_wetindex(packed.wet_index(mask),
+                                               mask.size)
+                else:
+                    data = np.asarray(ds.variables[name][:])
+                newds.write_variable(name, data, idx, writer=writer)
 
 
 def read(self, name, tile):
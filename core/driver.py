@@ -25,8 +25,7 @@ class Giga:
             elif var.space.is_level:
                 level = var.space.level
                 assert isinstance(level, int)
-                var._arrays = {tile: array[level].copy()
-                               for tile, array in var._arrays.items()}
+                var.keep_level(level)
 
     def print_status(self):
         self.reader.hist.print_status()
@@ -3,6 +3,7 @@
 import xarray as xr
 import numpy as np
 import bBDF
+import binio
 import glob
 import os
 
@@ -92,13 +93,13 @@ def fix_numpy_float_int(attrs):
     return vattrs
 
 
-def allocate_empty_binfile(binfile, filesize):
+def allocate_empty_binfile(binfile, filesize, header=None, reserve=False):
     if os.path.isfile(binfile):
         print(f"Warning {binfile} already exist")
     else:
-        command = f"dd if=/dev/zero of={binfile} bs=1 count=0 seek={filesize}"
-        print(command)
-        os.system(command)
+        layout = binio.allocate_file(binfile, filesize,
+                                     header=header, reserve=reserve)
+        print(f"allocate {binio.layout_summary(layout)}")
 
 
 def convert_grd(subd):
@@ -109,8 +110,7 @@ def convert_grd(subd):
     newds.set_structure(infos)
 
     # os.remove(target_grid)
-    allocate_empty_binfile(target_grid, newds.filesize)
-    newds.write_header()
+    allocate_empty_binfile(target_grid, newds.filesize, header=newds.header)
 
     tiles = infos["tiles"]
 
@@ -212,17 +212,7 @@ def readlocs(args):
     reader, tile, date, varname, locs = args
     jdx, idx = locs
     nlocs = len(jdx)
-    shape = reader.variable_shape[varname]
-    if len(shape)==3:
-        nz = shape[0]
-        result = np.zeros((24, nlocs, nz))
-    else:
-        result = np.zeros((24, nlocs))
-    for hour in range(24):
-        data=reader.read(tile, date, hour, varname)
-        for k in range(nlocs):
-            result[hour, k, ...] = data[..., jdx[k], idx[k]]
-    return result
+    return reader.gather([tile]*nlocs, (jdx, idx), [date], varname)
 
 pool = schwimmbad.MultiPool(processes=nworkers+1)
 
@@ -1,18 +1,14 @@
-from shapely.geometry.polygon import Polygon
+import tileindex
 
 def find_tiles_inside(param, domain, oceanonly=True):
     """Determine which tiles are inside `domain`
 
     The function uses `corners` the list of corners for each tile
     """
-    p = Polygon(domain)
-    tileslist = []
-    for tile, c in param.corners.items():
-        if (not oceanonly) or (not param.missing[tile]):
-            q = Polygon(c)
-            if p.overlaps(q) or p.contains(q):
-                tileslist += [tile]
-    return tileslist
+    index = tileindex.get_index(param.corners)
+    tileslist = index.query(domain, tileindex.overlaps_or_contains)
+    return [tile for tile in tileslist
+            if (not oceanonly) or (not param.missing[tile])]
 
 
 def square_domain(param,tileslist):
@@ -9,7 +9,7 @@
 import os
 import sys
 import glob
-from shapely.geometry.polygon import Polygon
+import tileindex
 import pickle
 from pretty import BB
 import pretty
@@ -479,13 +479,8 @@ def find_tiles_inside(domain, corners):
 
     The function uses `corners` the list of corners for each tile
     """
-    p = Polygon(domain)
-    tileslist = []
-    for tile, c in corners.items():
-        q = Polygon(c)
-        if p.overlaps(q) or p.contains(q):
-            tileslist += [tile]
-    return tileslist
+    index = tileindex.get_index(corners)
+    return index.query(domain, tileindex.overlaps_or_contains)
 
 
 def get_dates():
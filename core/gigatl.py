@@ -2,6 +2,7 @@ import numpy as np
 import os
 from shapely.geometry.polygon import Polygon, Point
 import pickle
+import tileindex
 import matplotlib.pyplot as plt
 from matplotlib import colors
 from matplotlib import cm
@@ -42,10 +43,7 @@ def get_bbox_from_tiles(tiles):
 def get_tiles_inside(domain):
     """ Returns the list of tiles having grid points in domain """
     domain_corners = get_corners_from_domain(domain)
-    p = Polygon(domain_corners)
-    return [tile
-            for tile, q in polygon_tiles.items()
-            if p.intersects(q)]
+    return index.query(domain_corners, tileindex.intersects)
 
 
 def get_subds_from_tiles(tiles):
@@ -225,6 +223,8 @@ assert len(subdmap) == 6582, msg
 polygon_tiles = {tile: Polygon(c)
                  for tile, c in corners.items()}
 
+index = tileindex.TileIndex(corners, polygons=polygon_tiles)
+
 regions = {subd: set([tile
                       for tile, s in subdmap.items()
                       if s == subd])
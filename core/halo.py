@@ -1,96 +1,245 @@
+import sys
 import numpy as np
+from numba import njit, prange
+from numba.typed import List
 
 
-def exchange(arrays, nh):
-    tiles = list(arrays)
-    ntiles = len(tiles)
-    c = np.zeros((ntiles, 2), dtype="b")
-    for k in range(ntiles):
-        c[k] = tilec(tiles[k])
-
-    j0, j1 = c[:, 0].min(), c[:, 0].max()
-    i0, i1 = c[:, 1].min(), c[:, 1].max()
-
-    data = arrays
-
-    for j in range(j0+1, j1+1):
-        for i in range(i0+1, i1+1):
-            tile0 = ctile(j-1, i)
-            tile1 = ctile(j, i-1)
-            if (tile0 in tiles) and (tile1 in tiles):
-                exchange_halo(data[tile0],
-                              data[tile1],
-                              nh, "rightbottom")
-
-            tile0 = ctile(j-1, i-1)
-            tile1 = ctile(j, i)
-            if (tile0 in tiles) and (tile1 in tiles):
-                exchange_halo(data[tile0],
-                              data[tile1],
-                              nh, "leftbottom")
-
-    for j in range(j0+1, j1+1):
-        for i in range(i0, i1+1):
-
-            tile0 = ctile(j-1, i)
-            tile1 = ctile(j, i)
-            if (tile0 in tiles) and (tile1 in tiles):
-                exchange_halo(data[tile0],
-                              data[tile1],
-                              nh, "bottom")
-
-    for j in range(j0, j1+1):
-        for i in range(i0+1, i1+1):
-
-            tile0 = ctile(j, i-1)
-            tile1 = ctile(j, i)
-            if (tile0 in tiles) and (tile1 in tiles):
-                exchange_halo(data[tile0],
-                              data[tile1],
-                              nh, "left")
-
-
-def exchange_halo(B, A, nh, what):
-    Aouter = slice(-nh, None)
-    Ainner = slice(-nh-nh, -nh)
-    Bouter = slice(nh)
-    Binner = slice(nh, nh+nh)
-    inner = slice(nh, -nh)
-
-    if what == "left":
-        A[inner, Aouter] = B[inner, Binner]
-        B[inner, Bouter] = A[inner, Ainner]
-
-    elif what == "bottom":
-        A[Aouter, inner] = B[Binner, inner]
-        B[Bouter, inner] = A[Ainner, inner]
-
-    elif what == "leftbottom":
-        A[Aouter, Aouter] = B[Binner, Binner]
-        B[Bouter, Bouter] = A[Ainner, Ainner]
-
-    elif what == "rightbottom":
-        A[Aouter, Bouter] = B[Binner, Ainner]
-        B[Bouter, Aouter] = A[Ainner, Binner]
-
-    else:
-        raise ValueError
-
-
-def reallocate(Ashort, nh):
-    if Ashort.ndim == 2:
-        ny, nx = Ashort.shape
-        shape = (ny+2*nh, nx+2*nh)
-    elif Ashort.ndim == 3:
-        nz, ny, nx = Ashort.shape
-        shape = (nz, ny+2*nh, nx+2*nh)
-
-    A = np.zeros(shape, dtype=Ashort.dtype)+np.nan
-    inner = slice(nh, -nh)
-    A[..., inner, inner] = Ashort
+# size of a GIGATL tile at rho points
+TILESHAPE = (140, 105)
+
+# extra points (along j, along i) of the staggered grids with respect
+# to the rho points, used when the arrays do not have the size of a
+# GIGATL tile
+EXTRAPOINTS = {"r": (0, 0), "u": (0, 1), "v": (1, 0), "f": (1, 1)}
+
+# plans already built, (tiles, nh, shape, period) -> HaloPlan
+plans = {}
+
+
+def tile_period(shape, horiz="r"):
+    """the period (ny, nx) of the tiles in the global mosaic
+
+    shape: the (ny, nx) shape of the arrays without halo
+    horiz: the horizontal staggering (r, u, v or f)
+
+    tile (j, i) starts at global index (j*ny, i*nx). Arrays of a
+    GIGATL tile, possibly with one extra point along each axis, have
+    the period TILESHAPE. Otherwise the period is the shape minus the
+    extra points of the staggering
+    """
+    ny, nx = shape[-2:]
+    if ((ny-TILESHAPE[0]) in (0, 1)) and ((nx-TILESHAPE[1]) in (0, 1)):
+        return TILESHAPE
+    ey, ex = EXTRAPOINTS[horiz]
+    return (ny-ey, nx-ex)
+
+
+def get_plan(tiles, nh, shape, period=None):
+    """the (cached) HaloPlan of a set of tiles"""
+    shape = tuple(shape[-2:])
+    period = shape if period is None else tuple(period)
+    key = (tuple(sorted(tiles)), nh, shape, period)
+    if key not in plans:
+        plans[key] = HaloPlan(tiles, nh, shape, period)
+    return plans[key]
+
+
+def exchange(arrays, nh, horiz="r"):
+    """fill the halos of `arrays` (dict tile -> haloed array)
+
+    the arrays are 2D (ny, nx) or 3D (nz, ny, nx) with a halo of
+    width nh on the last two dimensions. horiz is the horizontal
+    staggering, see tile_period
+
+    the plan is built once per set of tiles, halo width and shape
+    """
+    array = next(iter(arrays.values()))
+    shape = (array.shape[-2]-2*nh, array.shape[-1]-2*nh)
+    period = tile_period(shape, horiz)
+    get_plan(list(arrays), nh, shape, period).execute(arrays)
+
+
+class HaloPlan:
+    """list of the copies that fill the halos of a set of tiles
+
+    tile (j, i) is at row j and column i of the 100x100 array of
+    tiles (see Block.aggregate). Each halo (four sides and four
+    corners) is filled from the neighbouring tile, if it is in the
+    set. The arrays have the halo on their last two dimensions, the
+    leading ones (levels) are copied at once.
+
+    shape is the (ny, nx) shape of the arrays without halo, period
+    is the (ny, nx) period of the tiles in the global mosaic (default
+    shape). With one extra point (e.g. u or v points), the last row
+    or column of a tile is also the first one of its neighbour.
+
+    The plan is independent of the variable, the level and the time
+    """
+
+    def __init__(self, tiles, nh, shape=None, period=None):
+        self.tiles = sorted(tiles)
+        self.tileindex = {tile: k for k, tile in enumerate(self.tiles)}
+        self.nh = nh
+        self.shape = shape
+        self.period = shape if period is None else period
+        tileset = set(tiles)
+        self.copies = []
+        for tile in self.tiles:
+            j, i = tilec(tile)
+            for dj in (-1, 0, 1):
+                for di in (-1, 0, 1):
+                    if (dj, di) == (0, 0):
+                        continue
+                    if not ((0 <= j+dj < 100) and (0 <= i+di < 100)):
+                        continue
+                    src = ctile(j+dj, i+di)
+                    if src in tileset:
+                        dst_slices, src_slices = halo_slices(
+                            dj, di, nh, self.shape, self.period)
+                        self.copies += [(src, src_slices, tile, dst_slices)]
+        self.table = self._table()
+
+    def _table(self):
+        """the copies as an integer table, one row per copy:
+        src, dst (index in self.tiles), jsrc, isrc, jdst, idst, nj, ni
+        """
+        table = np.zeros((len(self.copies), 8), dtype="i8")
+        for k, (src, (jsrc, isrc), dst, (jdst, idst)) in enumerate(self.copies):
+            table[k] = (self.tileindex[src], self.tileindex[dst],
+                        jsrc.start, isrc.start, jdst.start, idst.start,
+                        jdst.stop-jdst.start, idst.stop-idst.start)
+        return table
+
+    def __len__(self):
+        return len(self.copies)
+
+    def execute(self, arrays):
+        """fill the halos of `arrays` (dict tile -> haloed array)
+
+        the whole table is done in one call of the kernel
+        """
+        if len(self) == 0:
+            return
+        views = List([as3d(arrays[tile]) for tile in self.tiles])
+        copy_blocks(views, self.table)
+
+
+def as3d(array):
+    """(nz, ny, nx) view of a 2D or 3D array"""
+    return array.reshape((-1,)+array.shape[-2:])
+
+
+@njit(parallel=True)
+def copy_blocks(arrays, table):
+    """do the copies of a HaloPlan table on the (nz, ny, nx) arrays
+
+    for each row (src, dst, jsrc, isrc, jdst, idst, nj, ni)
+    arrays[dst][:, jdst:jdst+nj, idst:idst+ni] = arrays[src][:, jsrc:..., isrc:...]
+
+    parallelized over the copies and the levels: the copies write in
+    the halos and read in the interiors, they are independent
+    """
+    nz = arrays[0].shape[0]
+    for n in prange(table.shape[0]*nz):
+        c = n // nz
+        k = n - c*nz
+        src = arrays[table[c, 0]]
+        dst = arrays[table[c, 1]]
+        jsrc, isrc = table[c, 2], table[c, 3]
+        jdst, idst = table[c, 4], table[c, 5]
+        for j in range(table[c, 6]):
+            for i in range(table[c, 7]):
+                dst[k, jdst+j, idst+i] = src[k, jsrc+j, isrc+i]
+
+
+def halo_slices(dj, di, nh, shape, period):
+    """slices of the halo of a tile in direction (dj, di) and of the
+    corresponding points of its neighbour (indices in the haloed
+    arrays)
+
+    a point at index l of a tile (without halo) is at index l+n of
+    its neighbour in direction -1 and at index l-n of its neighbour in
+    direction +1, with n the period
+    """
+    def pair(d, size, n):
+        if d == -1:
+            return slice(0, nh), slice(n, n+nh)
+        elif d == 0:
+            return slice(nh, nh+size), slice(nh, nh+size)
+        else:
+            return (slice(nh+size, size+2*nh),
+                    slice(size-n+nh, size-n+2*nh))
+    jdst, jsrc = pair(dj, shape[0], period[0])
+    idst, isrc = pair(di, shape[1], period[1])
+    return (jdst, idst), (jsrc, isrc)
+
+
+def reallocate(Ashort, nh, out=None):
+    """copy Ashort in the interior of a haloed array, the halo is NaN
+
+    out: the haloed array, allocated if None (e.g. a tile of an Arena)
+    """
+    shape = Ashort.shape[:-2]+haloshape(Ashort.shape[-2:], nh)
+    A = np.empty(shape, dtype=Ashort.dtype) if out is None else out
+    fill_edges(A, nh)
+    A[..., interior(nh), interior(nh)] = Ashort
     return A
 
 
+def haloshape(shape, nh):
+    ny, nx = shape
+    return (ny+2*nh, nx+2*nh)
+
+
+def interior(nh):
+    """slice of the interior along one axis"""
+    return slice(nh, -nh if nh > 0 else None)
+
+
+def fill_edges(A, nh, value=np.nan):
+    """fill only the halo of A (last two dimensions) with value"""
+    if nh == 0:
+        return
+    A[..., :nh, :] = value
+    A[..., -nh:, :] = value
+    A[..., nh:-nh, :nh] = value
+    A[..., nh:-nh, -nh:] = value
+
+
+class Arena:
+    """reusable memory for a stack of haloed tiles
+
+    stack() returns a (ntiles,)+leading dims+(ny+2nh, nx+2nh) array
+    with NaN halos, taken from one contiguous block. The block is
+    reused by the next call (it grows when needed) only if the
+    previous stack is no longer referenced: a stack still in use (e.g.
+    by a Variable) is never overwritten, a new block is allocated.
+    """
+
+    def __init__(self):
+        self.block = np.empty((0,), dtype="u1")
+
+    def in_use(self):
+        """True if an array still views the block
+
+        (the views of the block, and views of views, have the block
+        as base, self.block and the argument of getrefcount are the
+        two other references)
+        """
+        return sys.getrefcount(self.block) > 2
+
+    def stack(self, ntiles, shape, nh, dtype):
+        """shape: the shape of one tile, without halo"""
+        dtype = np.dtype(dtype)
+        stackshape = (ntiles,)+tuple(shape[:-2])+haloshape(shape[-2:], nh)
+        nbytes = int(np.prod(stackshape))*dtype.itemsize
+        if (self.block.nbytes < nbytes) or self.in_use():
+            self.block = np.empty((nbytes,), dtype="u1")
+        stack = self.block[:nbytes].view(dtype).reshape(stackshape)
+        fill_edges(stack, nh)
+        return stack
+
+
 def ctile(j, i):
     return j*100+i
 
@@ -113,36 +262,9 @@ class Block:
                       for i in range(i0, i0+npx)]
 
     def add_halo(self, fields, nh):
-        j0, i0 = self.corner
-        npy, npx = self.shape
         data = {tile: reallocate(field, nh)
                 for tile, field in fields.items()}
-
-        for j in range(j0+1, j0+npy):
-            for i in range(i0+1, i0+npx):
-
-                exchange_halo(data[ctile(j-1, i)],
-                              data[ctile(j, i-1)],
-                              nh, "rightbottom")
-
-                exchange_halo(data[ctile(j-1, i-1)],
-                              data[ctile(j, i)],
-                              nh, "leftbottom")
-
-        for j in range(j0+1, j0+npy):
-            for i in range(i0, i0+npx):
-
-                exchange_halo(data[ctile(j-1, i)],
-                              data[ctile(j, i)],
-                              nh, "bottom")
-
-        for j in range(j0, j0+npy):
-            for i in range(i0+1, i0+npx):
-
-                exchange_halo(data[ctile(j, i-1)],
-                              data[ctile(j, i)],
-                              nh, "left")
-
+        exchange(data, nh)
         return data
 
     def aggregate(self, fields):
@@ -166,21 +288,7 @@ class Block:
 
 
 def test():
-    nh = 2
-    ny, nx = (5, 3)
     dtype = "f"
-    shape = (ny+2*nh, nx+2*nh)
-    A = np.ones(shape, dtype=dtype)
-    B = np.ones(shape, dtype=dtype)*2
-    C = np.ones(shape, dtype=dtype)*3
-    exchange_halo(A, B, nh, "left")
-    #exchange_halo(A, B, "bottom")
-    exchange_halo(A, C, nh, "leftbottom")
-
-    print(f"A=\n{A}")
-    print(f"B=\n{B}")
-    print(f"C=\n{C}")
-
     block = Block((45, 45), (10, 10))
 
     ny, nx = 145, 105
@@ -196,6 +304,50 @@ def test():
     plt.imshow(gdata, origin="lower")
 
 
+def test_exchange():
+    """compare the halos with a brute-force global mosaic
+
+    for 2D and 3D arrays at r, u, v and f points, on a block of tiles
+    with a missing tile
+    """
+    nh = 2
+    ny, nx = 6, 5
+    corner = (40, 60)
+    npy, npx = 3, 4
+    block = Block(corner, (npy, npx))
+    missing = ctile(corner[0]+1, corner[1]+2)
+    tiles = [tile for tile in block.tiles if tile != missing]
+    for horiz, (ey, ex) in EXTRAPOINTS.items():
+        for levels in [(), (3,)]:
+            # global field, with NaN around
+            shape = (npy*ny+ey, npx*nx+ex)
+            glo = np.full(levels+(shape[0]+2*nh, shape[1]+2*nh), np.nan)
+            glo[..., nh:-nh, nh:-nh] = np.random.uniform(size=levels+shape)
+
+            def window(tile, halowidth):
+                j, i = tilec(tile)
+                j, i = j-corner[0], i-corner[1]
+                jdx = slice(nh-halowidth+j*ny, nh+halowidth+j*ny+ny+ey)
+                idx = slice(nh-halowidth+i*nx, nh+halowidth+i*nx+nx+ex)
+                return glo[..., jdx, idx].copy()
+
+            arrays = {tile: reallocate(window(tile, 0), nh)
+                      for tile in tiles}
+            exchange(arrays, nh, horiz)
+            for tile in tiles:
+                ref = window(tile, nh)
+                # the halo facing the missing tile is not filled
+                j, i = tilec(tile)
+                jm, im = tilec(missing)
+                if (abs(jm-j) <= 1) and (abs(im-i) <= 1):
+                    (jdx, idx), _ = halo_slices(jm-j, im-i, nh,
+                                                (ny+ey, nx+ex), (ny, nx))
+                    ref[..., jdx, idx] = np.nan
+                assert np.array_equal(arrays[tile], ref, equal_nan=True), \
+                    f"halo error for tile {tile} at {horiz} points"
+    print("halo exchange: ok")
+
+
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
     plt.ion()
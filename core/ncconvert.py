@@ -17,6 +17,7 @@ import time
 import schwimmbad
 import tar_tools as tt
 import rgdf
+import binio
 
 
 class Convert():
@@ -40,10 +41,11 @@ class Convert():
         assert isinstance(dates, list)
         assert isinstance(tiles, list)
         for date in dates:
-            self.create_destdir(date, subd)
-            self.allocate_empty_binfile(date, subd)
+            self.prepare(date, subd)
 
-        tasks = [(date, subd, t) for t in tiles for date in dates]
+        tasks = [(date, subd, t)
+                 for date in dates
+                 for t in self.tiles_to_convert(date, subd, tiles)]
 
         pool = schwimmbad.MultiPool(processes=nworkers+1)
         tic = time.time()
@@ -65,10 +67,11 @@ class Convert():
         tiles = [t for t, s in self.tg.subdmap.items() if s == subd]
         
         for date in dates:
-            self.create_destdir(date, subd)
-            self.allocate_empty_binfile(date, subd)
+            self.prepare(date, subd)
 
-        tasks = [(date, subd, t) for t in tiles for date in dates]
+        tasks = [(date, subd, t)
+                 for date in dates
+                 for t in self.tiles_to_convert(date, subd, tiles)]
 
         pool = schwimmbad.MultiPool(processes=nworkers+1)
         tic = time.time()
@@ -86,12 +89,11 @@ class Convert():
         assert isinstance(dates, list)
         assert isinstance(subds, list)
         for date in dates:
-            tasks = []
             for subd in subds:
-                tasks += [(date, subd, t)
-                          for t, s in self.tg.subdmap.items() if s == subd]
-                self.create_destdir(date, subd)
-                self.allocate_empty_binfile(date, subd)
+                self.prepare(date, subd)
+                tiles = [t for t, s in self.tg.subdmap.items() if s == subd]
+                tasks = [(date, subd, t)
+                         for t in self.tiles_to_convert(date, subd, tiles)]
 
                 pool = schwimmbad.MultiPool(processes=nworkers+1)
                 tic = time.time()
@@ -105,12 +107,12 @@ class Convert():
                 self.cleantar(date, subd)
         
     def task_extract_convert(self, args):
+        # tasks are filtered beforehand with tiles_to_convert()
         date, subd, tile = args
-        if self.need_conversion(date, subd, tile):
-            for quarter in range(4):
-                self.tg.extract_from_tar(date, subd, tile, quarter)
-            hisfiles = [self.get_hisname(date, subd, tile, quarter) for quarter in range(4)]
-            rgdf.writesubd(date, tile, hisfiles)
+        for quarter in range(4):
+            self.tg.extract_from_tar(date, subd, tile, quarter)
+        hisfiles = [self.get_hisname(date, subd, tile, quarter) for quarter in range(4)]
+        rgdf.writesubd(date, tile, hisfiles)
 
 
     def create_destdir(self, date, subd):
@@ -134,23 +136,57 @@ class Convert():
         else:
             print(f"{destdir} not yet converted")
 
-    def allocate_empty_binfile(self, date, subd):
+    def prepare(self, date, subd):
+        """Create the directory and the RGDF file of (date, subd)
+
+        A file converted before the completion map existed has an
+        empty map: the map is rebuilt, otherwise all its tiles would
+        be converted again"""
+        self.create_destdir(date, subd)
+        if not self.allocate_empty_binfile(date, subd):
+            reader = rgdf.predefined_readers[subd]
+            if not reader.read_donemap(date).any():
+                print(f"empty completion map for {date} {subd:02} -> rebuild it")
+                self.rebuild_donemap(date, subd)
+
+    def allocate_empty_binfile(self, date, subd, reserve=False):
+        """Return True if the file was created, False if it exists"""
         binfile = f"{self.param.dirgigabin}/{subd:02}/giga_{date}_{subd:02}.dat"
         filesize = self.stripesize * self.ntiles[subd]
         if os.path.isfile(binfile):
             print(f"Warning {binfile} already exist")
+            return False
         else:
-            command = f"dd if=/dev/zero of={binfile} bs=1 count=0 seek={filesize}"
-            print(command)
-            os.system(command)
+            layout = binio.allocate_file(binfile, filesize, reserve=reserve)
+            print(f"allocate {binio.layout_summary(layout)}")
+            return True
 
     def need_conversion(self, date, subd, tile):
         """Determine if this tile at this date needs to be converted
 
-        Method: read zeta @ hour=23 and check whether it's all 0"""
+        Method: check the completion map in the file header"""
+        return tile in self.tiles_to_convert(date, subd, [tile])
+
+    def tiles_to_convert(self, date, subd, tiles):
+        """Return the tiles, among `tiles`, not yet converted
+
+        Method: one read of the completion map in the file header"""
+        reader = rgdf.predefined_readers[subd]
+        donemap = reader.read_donemap(date)
+        return [tile for tile in tiles
+                if not donemap[reader.index["tile"][tile]].all()]
+
+    def rebuild_donemap(self, date, subd):
+        """Fill the completion map of a file converted before the map
+        existed
+
+        Method: read zeta @ hour=23 of each tile and check whether
+        it's all 0 (slow, to be done once per file)"""
         reader = rgdf.predefined_readers[subd]
-        data = reader.read(tile, date, 23, "zeta")
-        return np.allclose(data, 0)
+        for tile in reader.data["definitions"]["tile"]:
+            data = reader.read(tile, date, 23, "zeta")
+            if not np.allclose(data, 0):
+                reader.mark_done(date, tile)
 
 
     def get_hisname(self, date, subd, tile, quarter):
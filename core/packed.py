@@ -0,0 +1,306 @@
+"""
+Ocean-only packed storage of the history files
+
+In a packed file only the wet points (mask_rho > 0) of each tile are
+stored. The wet points of one tile are described by its wet index:
+the flat indices (j*nx+i) of the wet points in the (ny, nx) plane, in
+increasing order. It is stored in the grid file (variable "wetindex",
+padded with -1) or computed from mask_rho.
+
+Layout of a packed file (after the bBDF-like header)
+
+   for each tile, for each hour, for each variable:
+       (nz, nwet[tile]) or (nwet[tile],) values
+
+reductions and gathers work on the packed vectors, the land is never
+expanded. Use scatter() to get back a NaN-filled plane.
+"""
+import numpy as np
+import os
+import bBDF
+import binio
+
+# value of the padding in the "wetindex" grid variable
+NOTWET = -1
+
+
+def wet_index(mask):
+    """flat indices of the wet points of `mask` (a 2D array)"""
+    return np.flatnonzero(np.asarray(mask).ravel() > 0).astype("i4")
+
+
+def pad_wetindex(wetindex, size):
+    """wet index padded with NOTWET to `size` elements (grid file)"""
+    padded = np.full((size,), NOTWET, dtype="i2")
+    padded[:len(wetindex)] = wetindex
+    return padded
+
+
+def strip_wetindex(padded):
+    """inverse of pad_wetindex"""
+    padded = np.asarray(padded)
+    return padded[padded != NOTWET].astype("i4")
+
+
+def pack(data, wetindex):
+    """the wet points of a (nz, ny, nx) or (ny, nx) array"""
+    shape = data.shape[:-2]+(data.shape[-2]*data.shape[-1],)
+    return data.reshape(shape)[..., wetindex]
+
+
+def scatter(packed, wetindex, shape, out=None):
+    """scatter packed values into a NaN-filled array of `shape`
+
+    shape is (ny, nx) or (nz, ny, nx)
+    """
+    if out is None:
+        out = np.empty(shape, dtype=packed.dtype)
+    out.fill(np.nan)
+    flat = out.reshape(out.shape[:-2]+(-1,))
+    flat[..., wetindex] = packed
+    return out
+
+
+def positions(wetindex, points):
+    """position in the packed vector of the flat indices `points`
+
+    land points get -1
+    """
+    points = np.asarray(points)
+    if len(wetindex) == 0:
+        return np.full(points.shape, -1)
+    pos = np.searchsorted(wetindex, points)
+    pos = np.minimum(pos, len(wetindex)-1)
+    return np.where(wetindex[pos] == points, pos, -1)
+
+
+class PackedDataset():
+    """packed history file of one region and one date
+
+    infos is a bBDF-like header with the extra entry "nwet", the
+    number of wet points of each tile (same order as the "tile"
+    dimension). The variables shape is the full shape, e.g. [nz, ny,
+    nx], only the leading (vertical) dimension is kept in the file.
+    """
+
+    def __init__(self, filename, use_mmap=False):
+        self.filename = filename
+        self.use_mmap = use_mmap
+        self._mmap = None
+
+    def set_structure(self, infos):
+        self.infos = infos
+        self.tiles = infos["dimensions"]["tile"]
+        self.tileindex = {tile: k for k, tile in enumerate(self.tiles)}
+        self.nhours = infos["dimensions"]["hour"]
+        self.nwet = np.asarray(infos["nwet"], dtype="i8")
+        self.varnames = list(infos["variables"])
+        self.shape = {}
+        self.nlevels = {}
+        self.dtype = {}
+        for name, varinfos in infos["variables"].items():
+            shape = tuple(varinfos["shape"])
+            self.shape[name] = shape
+            self.nlevels[name] = shape[0] if len(shape) == 3 else 1
+            self.dtype[name] = varinfos.get("dtype", bBDF.DEFAULT_DTYPE)
+        self.header = generate_header(infos)
+        self.headersize = infos["headersize"]
+        self.set_offset_table()
+
+    def get_structure(self):
+        infos = bBDF.read_infos(self.filename)
+        self.set_structure(infos)
+        return infos
+
+    def set_offset_table(self):
+        """self.offset_table[itile, hour, ivar] in bytes"""
+        itemsizes = np.asarray([np.dtype(self.dtype[name]).itemsize
+                                * self.nlevels[name]
+                                for name in self.varnames], dtype="i8")
+        # sizes of the variables for each tile
+        varsizes = self.nwet[:, np.newaxis]*itemsizes[np.newaxis, :]
+        varoffsets = np.cumsum(varsizes, axis=1)-varsizes
+        hoursizes = varsizes.sum(axis=1)
+        tilesizes = hoursizes*self.nhours
+        tileoffsets = np.cumsum(tilesizes)-tilesizes
+        hours = np.arange(self.nhours, dtype="i8")
+        self.offset_table = (self.headersize
+                             + tileoffsets[:, np.newaxis, np.newaxis]
+                             + hours[np.newaxis, :, np.newaxis]
+                             * hoursizes[:, np.newaxis, np.newaxis]
+                             + varoffsets[:, np.newaxis, :])
+        self.filesize = int(self.headersize+tilesizes.sum())
+
+    def get_offset(self, name, tile, hour):
+        itile = self.tileindex[tile]
+        return int(self.offset_table[itile, hour, self.varnames.index(name)])
+
+    def packed_shape(self, name, tile):
+        nwet = int(self.nwet[self.tileindex[tile]])
+        if len(self.shape[name]) == 3:
+            return (self.nlevels[name], nwet)
+        else:
+            return (nwet,)
+
+    def get_mmap(self):
+        if self._mmap is None:
+            self._mmap = np.memmap(self.filename, dtype="u1", mode="r")
+        return self._mmap
+
+    def read(self, name, tile, hour):
+        """the packed values (nz, nwet) or (nwet,) of `name`"""
+        offset = self.get_offset(name, tile, hour)
+        shape = self.packed_shape(name, tile)
+        dtype = self.dtype[name]
+        if self.use_mmap:
+            nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+            data = self.get_mmap()[offset:offset+nbytes].view(dtype)
+        else:
+            data = np.fromfile(self.filename, dtype=dtype,
+                               count=int(np.prod(shape)), offset=offset)
+        data.shape = shape
+        return data
+
+    def read_plane(self, name, tile, hour, wetindex, out=None):
+        """the values of `name` scattered in a NaN-filled array"""
+        packed = self.read(name, tile, hour)
+        return scatter(packed, wetindex, self.shape[name], out=out)
+
+    def write(self, name, tile, hour, packed):
+        offset = self.get_offset(name, tile, hour)
+        data = np.ascontiguousarray(packed, dtype=self.dtype[name])
+        assert data.shape == self.packed_shape(name, tile)
+        with open(self.filename, "rb+") as fid:
+            fid.seek(offset)
+            fid.write(data.tobytes())
+
+    def allocate_empty_file(self, reserve=False):
+        return binio.allocate_file(self.filename, self.filesize,
+                                   header=self.header, reserve=reserve)
+
+    def statistics(self, name, hour, tiles=None):
+        """mean, std, min and max of `name` over the wet points
+
+        the statistics are per level for 3D variables
+
+        Returns
+        -------
+        dict with "count", "mean", "std", "min" and "max"
+        """
+        if tiles is None:
+            tiles = self.tiles
+        nz = self.nlevels[name]
+        count = 0
+        total = np.zeros((nz,))
+        total2 = np.zeros((nz,))
+        vmin = np.full((nz,), np.inf)
+        vmax = np.full((nz,), -np.inf)
+        for tile in tiles:
+            data = self.read(name, tile, hour).reshape((nz, -1))
+            if data.shape[1] == 0:
+                continue
+            count += data.shape[1]
+            total += data.sum(axis=1, dtype="f8")
+            total2 += (data.astype("f8")**2).sum(axis=1)
+            vmin = np.minimum(vmin, data.min(axis=1))
+            vmax = np.maximum(vmax, data.max(axis=1))
+        mean = total/max(count, 1)
+        std = np.sqrt(np.maximum(total2/max(count, 1)-mean**2, 0.))
+        stats = {"count": count, "mean": mean, "std": std,
+                 "min": vmin, "max": vmax}
+        if len(self.shape[name]) != 3:
+            stats = {key: (val if key == "count" else val[0])
+                     for key, val in stats.items()}
+        return stats
+
+    def gather(self, name, tile, hours, wetindex, jdx, idx):
+        """values of `name` at points (jdx, idx) of `tile`
+
+        (mooring-style extraction) only the packed vectors are read,
+        land points are NaN
+
+        Returns
+        -------
+        array (nhours, npoints) or (nhours, nz, npoints)
+        """
+        nx = self.shape[name][-1]
+        points = np.asarray(jdx)*nx+np.asarray(idx)
+        pos = positions(wetindex, points)
+        wet = pos >= 0
+        nz = self.nlevels[name]
+        data = np.full((len(hours), nz, len(points)), np.nan, dtype="f")
+        for k, hour in enumerate(hours):
+            packed = self.read(name, tile, hour).reshape((nz, -1))
+            data[k][:, wet] = packed[:, pos[wet]]
+        if len(self.shape[name]) != 3:
+            data = data[:, 0]
+        return data
+
+
+def generate_header(infos):
+    """bBDF header of a packed file, the headersize is adjusted to
+    the header length when infos["headersize"] is 0"""
+    if infos["headersize"] == 0:
+        infos["headersize"] = len(bBDF.generate_header(infos))
+        infos["headersize"] = bBDF.roundup(infos["headersize"]+64, 4096)
+    return bBDF.generate_header(infos)
+
+
+def get_infos(tiles, nwet, variables, nhours=24, attrs=None):
+    """header of a packed file
+
+    Parameters
+    ----------
+    tiles: list of int
+    nwet: list of int, the number of wet points of each tile
+    variables: dict, {name: {"shape": [...], "dtype": ...}}
+    """
+    infos = {"headersize": 0,
+             "dimensions": {"tile": list(tiles), "hour": nhours},
+             "variables": variables,
+             "nwet": [int(n) for n in nwet]}
+    if attrs is not None:
+        infos["attrs"] = attrs
+    return infos
+
+
+def repack(read, tiles, wetindices, variables, filename, nhours=24):
+    """build a packed file from full planes
+
+    Parameters
+    ----------
+    read: function (varname, tile, hour) -> full array
+    tiles: list of int
+    wetindices: dict {tile: wet index}
+    variables: dict, {name: {"shape": [...], "dtype": ...}}
+    filename: str, the packed file to create
+
+    Returns
+    -------
+    the PackedDataset
+    """
+    nwet = [len(wetindices[tile]) for tile in tiles]
+    infos = get_infos(tiles, nwet, variables, nhours=nhours)
+    ds = PackedDataset(filename)
+    ds.set_structure(infos)
+    ds.allocate_empty_file()
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        for tile in tiles:
+            # the data of a tile is contiguous, it is written in file
+            # order, one chunk at a time (a whole tile-day would be
+            # held in memory)
+            wetindex = wetindices[tile]
+            for hour in range(nhours):
+                for name in ds.varnames:
+                    chunk = np.ascontiguousarray(
+                        pack(read(name, tile, hour), wetindex),
+                        dtype=ds.dtype[name])
+                    if chunk.size == 0:
+                        # a dry tile
+                        continue
+                    binio.pwrite_from(fd, chunk,
+                                      ds.get_offset(name, tile, hour))
+    finally:
+        os.close(fd)
+    return ds
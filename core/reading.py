@@ -1,10 +1,11 @@
 import gigatl
+import halo
 import bindatasets as bd
 from variables import Varinfos, Variable, Domain, Time, Space
+from tilecache import TileCache
 #import vinterp
 
 import numpy as np
-import schwimmbad
 #import multiprocessing as mp
 
 staggering = {'u': 'ur',
@@ -36,23 +37,27 @@ staggering = {'u': 'ur',
 
 class Gigatl:
 
-    def __init__(self, halowidth=0, nthreads=12, debug=False):
+    def __init__(self, halowidth=0, nthreads=12, debug=False,
+                 cachesize=4*1024**3, use_arena=False):
         self.halowidth = halowidth
         self.nthreads = nthreads
         #self.pool = mp.Pool(processes=self.nthreads)
         self.hist = bd.Dataset()
         self.grid = bd.GDataset()
+        self.hist.nthreads = nthreads
+        self.grid.nthreads = nthreads
         self.toc = {}
         self.toc.update(self.hist.toc)
         self.toc.update(self.grid.toc)
-        # buffer to store the grid arrays
-        self.buffer = {name: {}
-                       for name in self.grid.toc}
-        self.histbuffer = {name: {}
-                           for name in self.hist.toc}
-        self.histbuffer_domain = Domain()
-        self.histbuffer_time = Time()
+        # the grid tiles are pinned, the history tiles are evicted
+        # when the cache exceeds cachesize bytes
+        self.cache = TileCache(cachesize)
         self.debug = debug
+        # with use_arena, the haloed tiles of a variable are stored in
+        # an arena reused by the next read of the same variable name,
+        # once the previous Variable has been released (see halo.Arena)
+        self.use_arena = use_arena
+        self.arenas = {}
 
     def restart_pool(self):
         pass
@@ -61,80 +66,128 @@ class Gigatl:
         # self.pool = mp.Pool(processes=self.nthreads)
 
     def read(self, var: Varinfos):
-        """ Parallel multi tiles read"""
-        if var.varname in self.grid.toc:
-            reader = self.grid.read_tile
-            tiles = set(var)
-            buffered = set(self.buffer[var.varname])
-            missing = sorted(tiles.difference(buffered))
+        """ Parallel multi tiles read
 
+        the tiles are served from the cache when possible, only the
+        missing ones are read
+        """
+        if var.varname in self.grid.toc:
+            is_grid = True
         elif var.varname in self.hist.toc:
-            reader = self.hist.read_tile
-            tiles = set(var)
-            if ((var.domain == self.histbuffer_domain)
-                    and (var.time == self.histbuffer_time)):
-                buffered = set(self.histbuffer[var.varname])
-                missing = sorted(tiles.difference(buffered))
-            else:
-                # purge hist buffer
-                for name in self.hist.toc:
-                    self.histbuffer[name] = {}
-                buffered = {}
-                missing = tiles
+            is_grid = False
         else:
             raise ValueError(f"variable {var.varname} is not in the database")
 
+        keys = {tile: self.cachekey(var, tile) for tile in var}
+        if ((self.halowidth > 0) and self.use_arena
+                and not (is_grid or self.debug)):
+            self.read_haloed(var, keys)
+            return
+
+        found = {}
+        missing = []
+        for tile, key in keys.items():
+            array = self.cache.get(key)
+            if array is None:
+                missing += [tile]
+            else:
+                found[tile] = array
+        missing = sorted(missing)
+
         if len(missing) > 0:
-            tasks = iter([(var, tile) for tile in missing])
             print(
                 f"read from binary files {var.varname} ({len(missing)} missing tiles)")
             if self.debug:
+                reader = self.grid.read_tile if is_grid else self.hist.read_tile
                 date = var.time.date
 
                 def myreader(task):
                     print(
                         f"\r{date} reading tile: {task[-1]}", end="", flush=True)
                     return reader(task)
-                arrays = [myreader(task) for task in tasks]
+                arrays = [myreader((var, tile)) for tile in missing]
                 print(" DONE!")
+            elif is_grid and self.grid.has_mosaic(var.varname):
+                # views on the cached global mosaic
+                arrays = [self.grid.read((var.varname, tile))
+                          for tile in missing]
+            elif is_grid:
+                # persistent pool, tiles are returned via shared memory
+                arrays = self.grid.pread((var.varname, missing))
             else:
-                # with mp.Pool(processes=self.nthreads) as pool:
-                with schwimmbad.MultiPool(processes=self.nthreads) as pool:
-                    arrays = pool.map(reader, tasks)
-
-        else:
-            print(f"load from buffer {var.varname} ({len(tiles)} tiles)")
-            arrays = []
-
-        if var.varname in self.grid.toc:
-            var._arrays = {tile: array
-                           for tile, array in zip(missing, arrays)}
-            self.buffer[var.varname].update(
-                {tile: array
-                 for tile, array in zip(missing, arrays)})
-
-            buff = {tile: self.buffer[var.varname][tile]
-                    for tile in buffered}
-            var._arrays.update(buff)
-
+                arrays = self.hist.pread((var.varname, missing,
+                                          var.time.hour, var.time.date))
+            for tile, array in zip(missing, arrays):
+                found[tile] = array
+                self.cache.put(keys[tile], array, pin=is_grid)
         else:
-            var._arrays = {tile: array
-                           for tile, array in zip(missing, arrays)}
-            self.histbuffer[var.varname].update(
-                {tile: array
-                 for tile, array in zip(missing, arrays)})
-
-            self.histbuffer_domain = var.domain.copy()
-            self.histbuffer_time = var.time.copy()
+            print(f"load from cache {var.varname} ({len(keys)} tiles)")
 
-            buff = {tile: self.histbuffer[var.varname][tile]
-                    for tile in buffered}
-            var._arrays.update(buff)
+        # the tiles are gathered in the stack of var
+        var._arrays = {tile: found[tile] for tile in var}
 
         self.set_staggering(var)
 
         if self.halowidth > 0:
-            var.add_halo()
+            var.halowidth = self.halowidth
+            arena = None
+            if self.use_arena:
+                arena = self.arenas.setdefault(var.varname, halo.Arena())
+            var.add_halo(arena=arena)
+
+    def read_haloed(self, var, keys):
+        """ read the history tiles directly in the interior of haloed
+        arrays taken from the arena of the variable
+
+        the missing tiles come first in the stack, so that they are
+        read at once in a view of the stack
+        """
+        nh = self.halowidth
+        hits = {}
+        missing = []
+        for tile, key in keys.items():
+            array = self.cache.get(key)
+            if array is None:
+                missing += [tile]
+            else:
+                hits[tile] = array
+        missing = sorted(missing)
+        tiles = missing+sorted(hits)
+
+        varinfos = self.hist.toc[var.varname]
+        dtype = "f" if "packing" in varinfos else varinfos["dtype"]
+        arena = self.arenas.setdefault(var.varname, halo.Arena())
+        stack = arena.stack(len(tiles), varinfos["shape"], nh, dtype)
+        interiors = stack[..., halo.interior(nh), halo.interior(nh)]
+        for k, tile in enumerate(tiles[len(missing):], len(missing)):
+            interiors[k] = hits[tile]
+        if len(missing) > 0:
+            print(
+                f"read from binary files {var.varname} ({len(missing)} missing tiles)")
+            self.hist.pread((var.varname, missing,
+                             var.time.hour, var.time.date),
+                            out=interiors[:len(missing)])
+            if self.cache.budget > 0:
+                for k, tile in enumerate(missing):
+                    self.cache.put(keys[tile], interiors[k].copy())
+
+        var.halowidth = nh
+        var.set_stack(stack, tiles)
+        var.has_halo = True
+        self.set_staggering(var)
+        halo.exchange(var._arrays, nh, var.staggering.horiz)
+
+    def cachekey(self, var, tile):
+        """ key of a tile in the cache
+
+        (varname, tile, date, hour), date and hour are None for grid
+        variables. The cache holds whole tiles (all the levels), the
+        level selection is done on the variable after the read (see
+        Variable.keep_level), so the levels are not part of the key
+        """
+        if var.varname in self.grid.toc:
+            return (var.varname, tile, None, None)
+        return (var.varname, tile, var.time.date, var.time.hour)
 
     def set_staggering(self, var):
         stagg = staggering[var.varname]
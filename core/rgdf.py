@@ -2,6 +2,7 @@ import numpy as np
 from pretty import BB, MD, VA
 from ruamel import yaml
 from netCDF4 import Dataset as ncDataset
+import binio
 import os
 
 debug = False
@@ -21,6 +22,9 @@ GB = int(1e9)
 floattypes = {4: np.float32, 8: np.float64}
 floatsize = 4
 
+# size of the write buffer of the conversion (per process)
+WRITEBUFFERSIZE = 64*MiB
+
 hours = range(24)
 quarters = range(4)
 nz, ny, nx = 100, 140, 105
@@ -43,6 +47,9 @@ class Reader(object):
     def __init__(self, param, subd):
         self.datadir = param.dirgigabin
         self.subd = subd
+        # the writer of the file being converted (see get_writer)
+        self.writer = None
+        self.writerkey = None
         yamfile = f"{param.dirmodule}/data/giga_{subd:02}.yaml"
         with open(yamfile) as f:
             data = yaml.load(f, yaml.RoundTripLoader)
@@ -125,46 +132,160 @@ class Reader(object):
         self.offset = offset
         self.variable_shape = variable_shape
         self.variables = variables
+        self.set_offset_table()
 
-    def get_offset(self, *args, debug=False):
-        # convert plain arguments to dict of index
-        index = {}
+    def set_offset_table(self):
+        """ Precompute the offsets of all (tile, hour, variable)
+
+        self.offset_table[itile, ihour, ivar] is the offset (in
+        float units) of the variable, self.index[level][elem] is the
+        position of elem in its level
+        """
+        counts = [len(self.data["definitions"][level])
+                  for level in self.levels]
+        table = np.zeros(counts, dtype="i8") + self.headersize
         for k, level in enumerate(self.levels):
-            index[level] = self.data["definitions"][level].index(args[k])
+            index = np.arange(counts[k])
+            offset = np.asarray(self.offset[level], dtype="i8")
+            if level == self.stripes["level"]:
+                stripeindex = index // self.nelemperstripe
+                offset = (stripeindex*self.stripesize
+                          + offset[index % self.nelemperstripe])
+            else:
+                offset = offset[index]
+            shape = [1]*len(counts)
+            shape[k] = counts[k]
+            table += offset.reshape(shape)
+        self.offset_table = table
+        self.index = {level: {elem: k
+                              for k, elem in enumerate(self.data["definitions"][level])}
+                      for level in self.levels}
 
-        lev = self.stripes["level"]
-        stripeindex = index[lev] // self.nelemperstripe
-        index[lev] = index[lev] % self.nelemperstripe
+    def get_offset(self, *args, debug=False):
+        # convert plain arguments to the index in the offset table
+        index = tuple(self.index[level][arg]
+                      for level, arg in zip(self.levels, args))
         if debug:
             print(index)
-            print(f"stripeindex: {stripeindex}")
+        return int(self.offset_table[index])
 
-        offset = stripeindex*self.stripesize + self.headersize
-        for level in self.levels:
-            i = index[level]
-            offset += self.offset[level][i]
-        return offset
+    def offsets(self, tiles, hours, varnames):
+        """ Vectorized get_offset
+
+        tiles, hours and varnames are scalars or arrays, broadcast
+        against each other. Returns the offsets in float units.
+        """
+        def toindex(level, elems):
+            index = self.index[level]
+            return np.vectorize(index.__getitem__, otypes=["i8"])(elems)
 
-    def read(self, tile, date, hour, varname):
+        return self.offset_table[toindex("tile", tiles),
+                                 toindex("hour", hours),
+                                 toindex("variable", varnames)]
+
+    def read(self, tile, date, hour, varname,
+             levels=None, jslice=None, islice=None):
+        """ Read a variable
+
+        levels, jslice, islice restrict the read to a hyperslab (see
+        binio.hyperslab), only the selected bytes are read
+        """
         offset = self.get_offset(tile, hour, varname)
         shape = self.variable_shape[varname]
         count = np.prod(shape)
         dtype = floattypes[floatsize]
         filename = datafilename(self.datadir, date, self.subd)
-        data = np.fromfile(filename, count=count, offset=offset*floatsize, dtype=dtype)
+        if (levels, jslice, islice) != (None, None, None):
+            offsets, sizes, shape = binio.hyperslab(shape, floatsize,
+                                                    levels, jslice, islice)
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                raw = binio.gather_ranges(fd, offsets+offset*floatsize, sizes)
+            finally:
+                os.close(fd)
+            data = raw.view(dtype)
+        else:
+            data = np.fromfile(filename, count=count, offset=offset*floatsize, dtype=dtype)
         data.shape = shape
         return data
 
-    def write(self, tile, date, hour, varname, data):
+    def write(self, tile, date, hour, varname, data, writer=None):
         offset = self.get_offset(tile, hour, varname)
         shape = self.variable_shape[varname]
         count = np.prod(shape)
         dtype = floattypes[floatsize]
+        if writer is not None:
+            writer.write(offset*floatsize, data)
+            return
         filename = datafilename(self.datadir, date, self.subd)
         with open(filename, "rb+") as fid:
             fid.seek(offset*floatsize) # <- conversion to bytes
             fid.write(data.tobytes())
 
+    def stripe_writer(self, date, background=False, callback=None,
+                      buffersize=WRITEBUFFERSIZE):
+        """ Return a StripeWriter on the file of `date` """
+        filename = datafilename(self.datadir, date, self.subd)
+        return binio.StripeWriter(filename, self.stripesize*floatsize,
+                                  base=self.headersize*floatsize,
+                                  background=background,
+                                  callback=callback,
+                                  buffersize=buffersize)
+
+    def get_writer(self, date, background=False):
+        """ Return the StripeWriter on the file of `date`
+
+        the writer is kept open for the next tiles: one writer (and
+        one buffer) per process and file. The writer of the previous
+        file is closed.
+        """
+        key = (date, background)
+        if self.writerkey != key:
+            self.close_writer()
+            self.writer = self.stripe_writer(date, background=background)
+            self.writerkey = key
+        return self.writer
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.writerkey = None
+
+    def donemap_offset(self):
+        """ Offset (in bytes) of the completion map
+
+        the map has one byte per (tile, hour) and sits at the end of
+        the header of the first stripe
+        """
+        ntiles = len(self.data["definitions"]["tile"])
+        nhours = len(self.data["definitions"]["hour"])
+        return self.headersize*floatsize-ntiles*nhours
+
+    def mark_done(self, date, tile):
+        """ Mark the 24 hours of `tile` as converted """
+        nhours = len(self.data["definitions"]["hour"])
+        start = self.index["tile"][tile]*nhours
+        filename = datafilename(self.datadir, date, self.subd)
+        binio.write_done(filename, self.donemap_offset()+start, nhours)
+
+    def read_donemap(self, date):
+        """ Return the completion map, boolean array (ntiles, nhours) """
+        ntiles = len(self.data["definitions"]["tile"])
+        nhours = len(self.data["definitions"]["hour"])
+        filename = datafilename(self.datadir, date, self.subd)
+        donemap = binio.read_done(filename, self.donemap_offset(),
+                                  ntiles*nhours)
+        donemap.shape = (ntiles, nhours)
+        return donemap
+
+    def missing(self, date):
+        """ Return the list of (tile, hour) not yet converted """
+        tiles = self.data["definitions"]["tile"]
+        hours = self.data["definitions"]["hour"]
+        donemap = self.read_donemap(date)
+        return [(tiles[k], hours[h]) for k, h in np.argwhere(~donemap)]
+
     def read_ts(self, tile, loc, dates, varname):
         """ Read a timeseries at a given location
 
@@ -174,24 +295,61 @@ class Reader(object):
             Location within the tile, either (j, i) or (k, j, i)
         dates : list of date
         """
+        locs = tuple([index] for index in loc)
+        return self.gather([tile], locs, dates, varname)[:, 0]
+
+    def gather(self, tiles, locs, dates, varname):
+        """ Read the timeseries at many locations at once
+
+        The offsets of all the values are computed in one shot from
+        the offset table. For each date, the values are fetched from a
+        memory map of the file, in increasing offset order.
+
+        Parameters
+        ----------
+        tiles : array of int
+            The tile of each location
+        locs : tuple of arrays
+            Locations within the tiles, either (j, i) or (k, j, i).
+            For a 3D variable, (j, i) selects the whole column
+        dates : list of date
+
+        Returns
+        -------
+        data : array of shape (ntime, nlocs) or (ntime, nlocs, nz),
+        with ntime = len(dates)*24
+        """
         dtype = floattypes[floatsize]
-        nt = len(dates)*24
-        data = np.zeros((nt, ), dtype=dtype)
         shape = self.variable_shape[varname]
-
-        if len(shape) == 2:
-            j, i = loc
-            location_offset = i+j*shape[-1]
+        ny, nx = shape[-2:]
+        rows = np.asarray([self.index["tile"][tile] for tile in tiles])
+        ivar = self.index["variable"][varname]
+        if len(locs) == 3:
+            k, j, i = [np.asarray(index) for index in locs]
+            location_offset = (k*ny+j)*nx+i
+        elif len(shape) == 3:
+            j, i = [np.asarray(index)[:, np.newaxis] for index in locs]
+            k = np.arange(shape[0])[np.newaxis, :]
+            location_offset = (k*ny+j)*nx+i
         else:
-            k, j, i = loc
-            location_offset = i+(j+k*shape[-2])*shape[-1]
-        kt = 0
-        for date in dates:
+            j, i = [np.asarray(index) for index in locs]
+            location_offset = j*nx+i
+
+        # offsets has shape (nhours, nlocs[, nz])
+        base = self.offset_table[rows, :, ivar].T
+        base.shape += (1,)*(location_offset.ndim-1)
+        offsets = (base+location_offset).ravel()
+        order = np.argsort(offsets)
+        nhours = base.shape[0]
+
+        data = np.zeros((len(dates)*nhours,)+location_offset.shape, dtype=dtype)
+        values = np.zeros(offsets.shape, dtype=dtype)
+        for kt, date in enumerate(dates):
             filename = datafilename(self.datadir, date, self.subd)
-            for hour in range(24):
-                offset = self.get_offset(tile, hour, varname) + location_offset
-                data[kt] = np.fromfile(filename, count=1, offset=offset*floatsize, dtype=dtype)
-                kt += 1
+            mm = np.memmap(filename, dtype=dtype, mode="r")
+            values[order] = mm[offsets[order]]
+            del mm
+            data[kt*nhours:(kt+1)*nhours].flat = values
         return data
 
 def datafilename(datadir, date, subd):
@@ -217,7 +375,7 @@ def read(tile, date, hour, varname):
     return reader.read(tile, date, hour, varname)
 
 
-def writesubd(date, tile, hisfiles):
+def writesubd(date, tile, hisfiles, background=False):
 
     # allocate the buffer (largest one) that host the data
     # from the netCDF to the GDF file
@@ -231,30 +389,37 @@ def writesubd(date, tile, hisfiles):
     filename = datafilename(datadir, date, subd)
     assert os.path.isfile(filename)
 
+    # the records are written in the file order (hour, variable) and
+    # assembled in the buffer of the writer of this process, which is
+    # reused from one tile to the next
+    writer = reader.get_writer(date, background=background)
+
     for quarter in range(4):
         ncfile = hisfiles[quarter]
         with ncDataset(ncfile) as nc:
-            for varname in reader.variables:
-                varshape = reader.variable_shape[varname]
-                ndim = len(varshape)
-                ncshape = nc.variables[varname].shape
-
-                vidx, oidx, iidx = set_indices(varshape, ncshape, tile)
-
-                with open(filename, "rb+") as fid:
-                    for kt in range(6):
-                        hour = quarter*6+kt
-                        data[vidx].flat = 0.
-                        datain = nc.variables[varname][kt]
-                        if ndim == 3:
-                            data[(vidx,)+oidx] = datain[(vidx,)+iidx]
-                        else:
-                            data[(vidx,)+oidx] = datain[iidx]
-
-                        offset = reader.get_offset(tile, hour, varname)
-                        fid.seek(offset*floatsize)
-                        fid.write(data[vidx].tobytes())
-                print(f"\rwrite {date} {subd:02} {tile:04} {quarter} {varname}", end="", flush=True)
+            for kt in range(6):
+                hour = quarter*6+kt
+                for varname in reader.variables:
+                    varshape = reader.variable_shape[varname]
+                    ndim = len(varshape)
+                    ncshape = nc.variables[varname].shape
+
+                    vidx, oidx, iidx = set_indices(varshape, ncshape, tile)
+
+                    data[vidx].flat = 0.
+                    datain = nc.variables[varname][kt]
+                    if ndim == 3:
+                        data[(vidx,)+oidx] = datain[(vidx,)+iidx]
+                    else:
+                        data[(vidx,)+oidx] = datain[iidx]
+
+                    offset = reader.get_offset(tile, hour, varname)
+                    writer.write(offset*floatsize, data[vidx])
+                print(f"\rwrite {date} {subd:02} {tile:04} {hour:02}", end="", flush=True)
+    # the tile is marked as done once on disk
+    writer.flush()
+    writer.wait()
+    reader.mark_done(date, tile)
     print(f"\rwrite {date} {subd:02} {tile:04} -> done", flush=True)
 
 def set_indices(varshape, ncshape, tile):
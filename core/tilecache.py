@@ -0,0 +1,87 @@
+"""
+Byte-budgeted LRU cache of tiles
+
+the keys are tuples, e.g. (varname, tile, date, hour), the values
+are numpy arrays (whole tiles). When the total size exceeds the
+budget, the least recently used tiles are evicted. Pinned tiles (grid variables)
+are never evicted and do not count in the budget.
+"""
+from collections import OrderedDict
+
+
+class TileCache():
+    def __init__(self, budget=4*1024**3):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return (key in self.pinned) or (key in self.entries)
+
+    def __len__(self):
+        return len(self.pinned)+len(self.entries)
+
+    def get(self, key):
+        """the array of `key` or None"""
+        if key in self.pinned:
+            self.hits += 1
+            return self.pinned[key]
+        elif key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        else:
+            self.misses += 1
+            return None
+
+    def put(self, key, array, pin=False):
+        if pin:
+            self.pop(key)
+            self.pinned[key] = array
+            return
+        if key in self.pinned:
+            self.pinned[key] = array
+            return
+        self.pop(key)
+        if array.nbytes > self.budget:
+            # would flush the whole cache
+            return
+        while self.nbytes+array.nbytes > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        self.entries[key] = array
+        self.nbytes += array.nbytes
+
+    def pop(self, key):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.pinned.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        total = self.hits+self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitrate": self.hits/total if total > 0 else 0.,
+                "entries": len(self.entries),
+                "pinned": len(self.pinned),
+                "nbytes": self.nbytes,
+                "budget": self.budget}
+
+    def __repr__(self):
+        stats = self.stats()
+        return (f"TileCache: {stats['entries']} tiles"
+                f" ({stats['nbytes']/1024**2:.1f} / {self.budget/1024**2:.1f} MB)"
+                f" + {stats['pinned']} pinned,"
+                f" hits: {stats['hits']} misses: {stats['misses']}"
+                f" evictions: {stats['evictions']}")
@@ -0,0 +1,153 @@
+"""
+Spatial index of the tiles for lon/lat domain queries
+
+A query (which tiles are in a domain) is done in three steps
+
+   1) the grid buckets: the tiles whose bounding box touches the cells
+      of a regular lon/lat grid covered by the domain bounding box
+   2) a vectorized bounding box test on these candidates
+   3) the exact polygon test, on the remaining candidates only
+
+for a rectangular domain, the tiles whose bounding box is strictly
+inside the domain are accepted without the polygon test.
+
+The polygon test is a predicate(p, q), where p is the domain polygon
+and q the tile polygon, so that each caller keeps its own definition
+of "inside".
+"""
+import numpy as np
+from shapely.geometry.polygon import Polygon
+
+# the indexes built by get_index(), by id of the corners dict
+indexes = {}
+
+
+def intersects(p, q):
+    return p.intersects(q)
+
+
+def overlaps_or_contains(p, q):
+    return p.overlaps(q) or p.contains(q)
+
+
+def get_index(corners):
+    """ the TileIndex of `corners` (built once) """
+    key = id(corners)
+    if key not in indexes:
+        indexes[key] = (corners, TileIndex(corners))
+    return indexes[key][1]
+
+
+class TileIndex:
+    """ spatial index of tiles
+
+    corners: dict {tile: [(lon, lat) x 4]}
+    polygons: dict {tile: Polygon}, optional, otherwise the polygons
+    are built on demand
+    cellsize: size of the buckets, in degrees
+    """
+
+    def __init__(self, corners, polygons=None, cellsize=2.):
+        self.corners = corners
+        self.polygons = {} if polygons is None else polygons
+        self.tiles = np.asarray(list(corners), dtype="i4")
+        c = np.asarray([corners[tile] for tile in self.tiles], dtype="f8")
+        self.lonmin = c[:, :, 0].min(axis=1)
+        self.lonmax = c[:, :, 0].max(axis=1)
+        self.latmin = c[:, :, 1].min(axis=1)
+        self.latmax = c[:, :, 1].max(axis=1)
+        self.set_buckets(cellsize)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def set_buckets(self, cellsize):
+        """ buckets in CSR format: the positions of the tiles
+        touching cell c are self.bucket[self.start[c]:self.start[c+1]]
+        """
+        self.cellsize = cellsize
+        self.origin = (self.lonmin.min(), self.latmin.min())
+        i0, j0 = self.cell(self.lonmin, self.latmin)
+        i1, j1 = self.cell(self.lonmax, self.latmax)
+        self.ni = int(i1.max())+1
+        self.nj = int(j1.max())+1
+        cells, positions = [], []
+        for pos in range(len(self)):
+            jj, ii = np.meshgrid(np.arange(j0[pos], j1[pos]+1),
+                                 np.arange(i0[pos], i1[pos]+1),
+                                 indexing="ij")
+            cells += [(jj*self.ni+ii).ravel()]
+            positions += [np.full((jj.size,), pos)]
+        cells = np.concatenate(cells)
+        positions = np.concatenate(positions)
+        order = np.argsort(cells, kind="stable")
+        self.bucket = positions[order]
+        counts = np.bincount(cells, minlength=self.ni*self.nj)
+        self.start = np.concatenate([[0], np.cumsum(counts)])
+
+    def cell(self, lon, lat):
+        """ (i, j) of the cell of (lon, lat) """
+        i = np.floor((np.asarray(lon)-self.origin[0])/self.cellsize)
+        j = np.floor((np.asarray(lat)-self.origin[1])/self.cellsize)
+        return i.astype("i8"), j.astype("i8")
+
+    def candidates(self, bbox):
+        """ positions of the tiles whose bounding box intersects
+        bbox = (lonmin, latmin, lonmax, latmax) """
+        xa, ya, xb, yb = bbox
+        i0, j0 = self.cell(xa, ya)
+        i1, j1 = self.cell(xb, yb)
+        i0, j0 = max(i0, 0), max(j0, 0)
+        i1, j1 = min(i1, self.ni-1), min(j1, self.nj-1)
+        if (i1 < i0) or (j1 < j0):
+            return np.zeros((0,), dtype="i8")
+        if (i1-i0+1)*(j1-j0+1)*4 > self.ni*self.nj:
+            # large domain, the buckets don't help
+            pos = np.arange(len(self))
+        else:
+            # the cells of one row are contiguous in the buckets
+            rows = [self.bucket[self.start[j*self.ni+i0]:
+                                self.start[j*self.ni+i1+1]]
+                    for j in range(j0, j1+1)]
+            pos = np.unique(np.concatenate(rows))
+        keep = ((self.lonmax[pos] >= xa) & (self.lonmin[pos] <= xb)
+                & (self.latmax[pos] >= ya) & (self.latmin[pos] <= yb))
+        return pos[keep]
+
+    def polygon(self, tile):
+        if tile not in self.polygons:
+            self.polygons[tile] = Polygon(self.corners[tile])
+        return self.polygons[tile]
+
+    def query(self, domain, predicate=intersects):
+        """ tiles for which predicate(Polygon(domain), tile polygon)
+        is True, in the order of corners
+
+        domain: list of (lon, lat), the vertices of the domain
+        """
+        p = Polygon(domain)
+        xa, ya, xb, yb = p.bounds
+        pos = self.candidates((xa, ya, xb, yb))
+        if p.equals(p.envelope):
+            # tiles strictly inside a rectangular domain
+            inside = ((self.lonmin[pos] > xa) & (self.lonmax[pos] < xb)
+                      & (self.latmin[pos] > ya) & (self.latmax[pos] < yb))
+        else:
+            inside = np.zeros(pos.shape, dtype=bool)
+        tiles = self.tiles[pos]
+        return [int(tile) for tile, sure in zip(tiles, inside)
+                if sure or predicate(p, self.polygon(tile))]
+
+
+def test_query(corners, ndomains=100, predicate=intersects):
+    """ compare the queries with a brute-force scan """
+    index = TileIndex(corners)
+    for k in range(ndomains):
+        xa, xb = np.sort(np.random.uniform(-100, 30, size=2))
+        ya, yb = np.sort(np.random.uniform(-60, 70, size=2))
+        domain = [(xa, ya), (xa, yb), (xb, yb), (xb, ya)]
+        p = Polygon(domain)
+        ref = [tile for tile, c in corners.items()
+               if predicate(p, Polygon(c))]
+        assert index.query(domain, predicate) == ref, f"error for {domain}"
+    print("tile index: ok")
@@ -0,0 +1,187 @@
+"""
+Time-innermost store for point and column time series
+
+The history files are organized by date, then tile, then hour: a
+time series at one point costs one read per hour. In a store, one
+variable over a chunk of dates is organized as
+
+   dimensions: tile, level
+   variable: [ny, ncols, ntime]
+
+i.e. for each (tile, k), the points are stored row by row and time is
+the innermost dimension. ncols is nx rounded up to a multiple of iblk
+(the columns are grouped by blocks of iblk points). The time series
+at one point is one contiguous read, a profile is nz reads.
+
+j and i are in the variable shape, not in the dimensions, so that the
+offset table of the store is (ntiles, nz) only.
+
+A store is a regular bBDF file, it is built from the daily files with
+build(), which reads all the levels of a (tile, date, hour) at once,
+or groups of levels when the tile does not fit in the buffer.
+"""
+import numpy as np
+import os
+import bBDF
+import binio
+
+
+def get_infos(varname, tiles, dates, shape, nhours=24, iblk=15, dtype="f"):
+    """header of the store of `varname`
+
+    shape: tuple, (nz, ny, nx) or (ny, nx) the shape of the variable
+    in the history files
+    """
+    nz = shape[0] if len(shape) == 3 else 1
+    ny, nx = shape[-2:]
+    ncols = -(-nx // iblk)*iblk
+    ntime = len(dates)*nhours
+    infos = {"headersize": 0,
+             "dimensions": {"tile": len(tiles), "level": nz},
+             "variables": {varname: {"shape": [ny, ncols, ntime],
+                                     "dtype": dtype}},
+             "varshape": list(shape),
+             "iblk": iblk,
+             "nhours": nhours,
+             "dates": list(dates),
+             "tile": list(tiles)}
+    # headersize is the rounded length of the header
+    headersize = len(bBDF.generate_header(infos))
+    infos["headersize"] = bBDF.roundup(headersize+64, 4096)
+    return infos
+
+
+class TimeSeriesStore():
+    """reader of a time-innermost store
+
+    the times are the (date, hour) of self.times, in that order
+    """
+
+    def __init__(self, filename, use_mmap=False):
+        self.filename = filename
+        self.dataset = bBDF.Dataset(filename, use_mmap=use_mmap)
+
+    def set_structure(self, infos):
+        self.infos = infos
+        self.dataset.set_structure(infos)
+        self.varname = list(infos["variables"])[0]
+        self.tiles = infos["tile"]
+        self.tileindex = {tile: k for k, tile in enumerate(self.tiles)}
+        self.iblk = infos["iblk"]
+        self.ny, self.ncols, self.ntime = infos["variables"][self.varname]["shape"]
+        self.nz = infos["dimensions"]["level"]
+        self.times = [(date, hour)
+                      for date in infos["dates"]
+                      for hour in range(infos["nhours"])]
+
+    def get_structure(self):
+        infos = bBDF.read_infos(self.filename)
+        self.set_structure(infos)
+        return infos
+
+    def location(self, tile, k, j, i):
+        """offset of the time series of the point in the store"""
+        ds = self.dataset
+        nbytes = ds.get_nbytes(self.varname)//(self.ny*self.ncols)
+        offset = ds.get_offset(self.varname, (self.tileindex[tile], k))
+        return offset+(j*self.ncols+i)*nbytes
+
+    def read_point(self, tile, j, i, k=0):
+        """time series at a point, one contiguous read
+
+        k is ignored for a 2D variable
+
+        Returns
+        -------
+        array of shape (ntime,)
+        """
+        k = k if self.nz > 1 else 0
+        idx = (self.tileindex[tile], k)
+        return self.dataset.read_variable(self.varname, idx,
+                                          levels=j, jslice=i)
+
+    def read_profile(self, tile, j, i):
+        """time series of a column, one read per level
+
+        Returns
+        -------
+        array of shape (nz, ntime)
+        """
+        return np.asarray([self.read_point(tile, j, i, k)
+                           for k in range(self.nz)])
+
+    def read_points(self, tile, jdx, idx, k=0):
+        """time series at several points of a tile
+
+        the points are read in increasing offset order, one read per
+        point (contiguous points are merged)
+
+        Returns
+        -------
+        array of shape (ntime, npoints) (mooring-style)
+        """
+        k = k if self.nz > 1 else 0
+        ds = self.dataset
+        nbytes = ds.get_nbytes(self.varname)//(self.ny*self.ncols)
+        offsets = [self.location(tile, k, j, i) for j, i in zip(jdx, idx)]
+        sizes = [nbytes]*len(offsets)
+        fd = os.open(self.filename, os.O_RDONLY)
+        try:
+            chunks = binio.read_ranges(fd, offsets, sizes)
+        finally:
+            os.close(fd)
+        dtype = ds.toc[self.varname]["dtype"]
+        return np.stack([chunk.view(dtype) for chunk in chunks], axis=1)
+
+
+def build(read, varname, tiles, dates, shape, filename,
+          nhours=24, iblk=15, dtype="f", buffersize=2*1024**3):
+    """build the store of `varname` from the daily files
+
+    Parameters
+    ----------
+    read: function (varname, tile, date, hour, levels) -> array, the
+    levels (a slice) of varname, as a (nlevels, ny, nx) array (levels
+    is ignored for 2D variables). It should read only these levels
+    (e.g. a hyperslab read)
+    tiles: list of int
+    dates: list of dates
+    shape: tuple, (nz, ny, nx) or (ny, nx) the shape of varname
+    filename: str, the store to create
+    buffersize: int, the size in bytes of the buffer
+
+    The levels of a tile are filled by groups that fit in the buffer
+    (all of them if possible), each (date, hour) of a group is one
+    read and the group is one contiguous write
+
+    Returns
+    -------
+    the TimeSeriesStore
+    """
+    infos = get_infos(varname, tiles, dates, shape, nhours=nhours,
+                      iblk=iblk, dtype=dtype)
+    store = TimeSeriesStore(filename)
+    store.set_structure(infos)
+    ds = store.dataset
+    ds.allocate_empty_file(force=True)
+
+    nz = infos["dimensions"]["level"]
+    ny, nx = shape[-2:]
+    ncols, ntime = store.ncols, store.ntime
+    levelsize = ny*ncols*ntime*np.dtype(dtype).itemsize
+    nlevels = min(max(buffersize//levelsize, 1), nz)
+    buffer = np.zeros((nlevels, ny, ncols, ntime), dtype=dtype)
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        for itile, tile in enumerate(tiles):
+            for k0 in range(0, nz, nlevels):
+                k1 = min(k0+nlevels, nz)
+                levels = slice(k0, k1)
+                for kt, (date, hour) in enumerate(store.times):
+                    data = read(varname, tile, date, hour, levels)
+                    buffer[:k1-k0, :, :nx, kt] = data.reshape((k1-k0, ny, nx))
+                offset = ds.get_offset(varname, (itile, k0))
+                binio.pwrite_from(fd, buffer[:k1-k0], offset)
+    finally:
+        os.close(fd)
+    return store
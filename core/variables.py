@@ -191,10 +191,10 @@ class Time:
 @dataclass
 class Varinfos():
     varname: str = ""
-    domain: Domain = Domain()
-    time: Time = Time()
-    space: Space = Space()
-    staggering: Staggering = Staggering()
+    domain: Domain = field(default_factory=Domain)
+    time: Time = field(default_factory=Time)
+    space: Space = field(default_factory=Space)
+    staggering: Staggering = field(default_factory=Staggering)
 
     def check(self):
         assert self.is_ok()
@@ -217,15 +217,40 @@ class Varinfos():
 
 @dataclass
 class Variable(Varinfos):
+    """ a Varinfos with its data
+
+    the tiles are stored in one contiguous array, the stack, of shape
+    (ntiles,)+shape of a tile. slots[tile] is the position of tile in
+    the stack and var[tile] is a view on stack[slots[tile]]
+
+    the whole-domain operations (reductions, elementwise math, level
+    selection) work on the stack, i.e. on all tiles at once
+    """
+    stack: np.ndarray = field(default=None, repr=False, compare=False)
+    slots: dict = field(default_factory=dict, repr=False, compare=False)
     has_halo = False
     halowidth = 3
-    _arrays = {}
-    # def __init__(self):
-    # arrays is a *list* sorted by tile
-    # self._copy(var)
-    #self.halowidth = halowidth
-    #self.has_halo = False
-    #self._arrays = {}
+
+    def set_stack(self, stack, tiles):
+        """ use stack (no copy) as the data of tiles"""
+        assert len(stack) == len(tiles)
+        self.stack = stack
+        self.slots = {tile: k for k, tile in enumerate(tiles)}
+
+    @property
+    def _arrays(self):
+        """ {tile: array} of views on the stack"""
+        return {tile: self.stack[k] for tile, k in self.slots.items()}
+
+    @_arrays.setter
+    def _arrays(self, arrays):
+        """ gather the arrays {tile: array} in a new stack"""
+        tiles = list(arrays)
+        if len(tiles) > 0:
+            self.set_stack(np.stack([arrays[tile] for tile in tiles]), tiles)
+        else:
+            self.stack = None
+            self.slots = {}
 
     def update(self, arrays):
         self.has_halo = False
@@ -234,23 +259,31 @@ class Variable(Varinfos):
 
     @property
     def ndim(self):
-        tile = self._getonetile()
-        return self._arrays[tile].ndim
+        return self.stack.ndim-1
 
     def _getonetile(self):
         return next(iter(self))
 
     @property
     def shape(self):
-        tile = self._getonetile()
-        if len(self._arrays) > 0:
-            return (len(self),)+self._arrays[tile].shape
+        if len(self.slots) > 0:
+            return self.stack.shape
         else:
             return (0,)
 
     def new(self, varname):
         return Variable(varname, self.domain, self.time, self.space)
 
+    def like(self, stack, varname=None):
+        """ a Variable on the same tiles, with stack as data"""
+        var = self.new(self.varname if varname is None else varname)
+        var.staggering = Staggering(self.staggering.horiz,
+                                    self.staggering.vert)
+        var.has_halo = self.has_halo
+        var.halowidth = self.halowidth
+        var.set_stack(stack, list(self.slots))
+        return var
+
     def _copy(self, var):
         self.varname = var.varname
         self.domain = var.domain
@@ -258,26 +291,129 @@ class Variable(Varinfos):
         self.space = var.space
 
     def __getitem__(self, tile):
-        return self._arrays[tile]
+        return self.stack[self.slots[tile]]
 
-    def add_halo(self):
-        """ add halos to arrays (deallocate previous arrays)"""
+    def __setitem__(self, tile, array):
+        self.stack[self.slots[tile]] = array
+
+    @property
+    def interior(self):
+        """ the stack without the halo (a view)"""
+        if self.has_halo:
+            nh = self.halowidth
+            return self.stack[..., halo.interior(nh), halo.interior(nh)]
+        else:
+            return self.stack
+
+    def aligned(self, other):
+        """ the stack of other with the tiles in the order of self"""
+        if list(other.slots) == list(self.slots):
+            return other.stack
+        else:
+            return other.stack[[other.slots[tile] for tile in self.slots]]
+
+    def map(self, func, *others, varname=None):
+        """ elementwise func(stack, *others) on all tiles at once
+
+        others are Variables on the same tiles, arrays or scalars
+        """
+        args = [self.aligned(other) if isinstance(other, Variable) else other
+                for other in others]
+        return self.like(func(self.stack, *args), varname)
+
+    def __add__(self, other):
+        return self.map(np.add, other)
+
+    def __radd__(self, other):
+        return self.map(np.add, other)
+
+    def __sub__(self, other):
+        return self.map(np.subtract, other)
+
+    def __rsub__(self, other):
+        return self.map(lambda a, b: b-a, other)
+
+    def __mul__(self, other):
+        return self.map(np.multiply, other)
+
+    def __rmul__(self, other):
+        return self.map(np.multiply, other)
+
+    def __truediv__(self, other):
+        return self.map(np.true_divide, other)
+
+    def __rtruediv__(self, other):
+        return self.map(lambda a, b: b/a, other)
+
+    def __neg__(self):
+        return self.map(np.negative)
+
+    def reduce(self, func, axis=None, **kwargs):
+        """ func (e.g. np.nanmean) over all tiles at once, the halo is
+        excluded
+
+        axis are the axes of the stack, 0 is the tile axis,
+        e.g. axis=(-2, -1) is the horizontal reduction of each tile
+        """
+        return func(self.interior, axis=axis, **kwargs)
+
+    def min(self, axis=None):
+        return self.reduce(np.nanmin, axis)
+
+    def max(self, axis=None):
+        return self.reduce(np.nanmax, axis)
+
+    def sum(self, axis=None):
+        return self.reduce(np.nansum, axis)
+
+    def mean(self, axis=None):
+        return self.reduce(np.nanmean, axis)
+
+    def std(self, axis=None):
+        return self.reduce(np.nanstd, axis)
+
+    def select_level(self, level):
+        """ Variable with the level `level` of each tile (a view)"""
+        return self.like(self.stack[:, level])
+
+    def keep_level(self, level):
+        """ keep only the level `level` (the other levels are freed)"""
+        self.set_stack(self.stack[:, level].copy(), list(self.slots))
+
+    def add_halo(self, arena=None):
+        """ add halos to arrays (deallocate previous arrays)
+
+        with an arena (halo.Arena) the haloed stack is taken from its
+        reusable block instead of being allocated
+        """
         if self.has_halo:
             print(f"variable is already haloed""")
             return
 
-        self.has_halo = True
+        nh = self.halowidth
+        tiles = list(self.slots)
+        shape = self.stack.shape[1:]
         # 1) allocate
-        arrays = {tile: halo.reallocate(array, self.halowidth)
-                  for tile, array in self._arrays.items()}
+        if arena is None:
+            stack = np.empty((len(tiles),)+shape[:-2]
+                             + halo.haloshape(shape[-2:], nh),
+                             dtype=self.stack.dtype)
+            halo.fill_edges(stack, nh)
+        else:
+            stack = arena.stack(len(tiles), shape, nh, self.stack.dtype)
+        stack[..., halo.interior(nh), halo.interior(nh)] = self.stack
         # 2) overwrite (and free the unhaloed arrays)
-        self._arrays = arrays
+        self.set_stack(stack, tiles)
+        self.has_halo = True
         # 3) exchange data across tiles
-        halo.exchange(self._arrays, self.halowidth)
+        halo.exchange(self._arrays, nh, self.staggering.horiz)
 
     def remove_halo(self):
         """ remove the halo"""
-        pass
+        if self.has_halo:
+            interior = self.interior.copy()
+            self.has_halo = False
+            self.set_stack(interior, list(self.slots))
 
 
 @dataclass
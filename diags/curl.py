@@ -4,8 +4,7 @@ from numba import jit
 
 
 def keeptoplevel(var):
-    var._arrays = {tile: array[-1].copy()
-                   for tile, array in var._arrays.items()}
+    var.keep_level(-1)
 
 
 class Curl:
@@ -11,4 +11,4 @@ class HeatFlux:
         AKv = var.new("AKv")
         self.reader.read(AKv)
         for tile in var:
-            var._arrays[tile] *= coef*AKv[tile][kz+1]
+            var[tile] *= coef*AKv[tile][kz+1]
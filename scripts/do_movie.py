@@ -46,7 +46,7 @@ subds = gigatl.get_subds_from_tiles(tiles)
 
 def proceed_tile(args):
     tile, hour, date = args
-    temp = ds.read(("temp", tile, hour, date))
+    temp = ds.read(("temp", tile, hour, date), levels=[-2, -1])
     data = temp[-1]-temp[-2]
     return data
 